@@ -22,10 +22,11 @@ import uvicorn
 import config
 from common_libs.data_schema import UICameraSetting, CameraSettingCheckResponse, \
     SettingImageResponse, UIOCRSetting, UIOCRSetting2, BaseThresholdSetting, UIThresholdSetting, UIMailSetting
-from rixiot_libs.ocr import get_perspective_image, load_image
+from rixiot_libs.ocr import get_perspective_geometry, load_image
 from common_libs.db_models import get_db
-from ocr.image_processing_task import OCRHandlerFactory
-from common_libs.models import CameraSetting, OCRSetting, ThresholdSetting, JsonTextStorage, MailSetting
+from ocr.image_processing_task import OCRHandlerFactory, refresh_setting_snapshot
+from common_libs.models import CameraSetting, OCRSetting, ThresholdSetting, JsonTextStorage, MailSetting, \
+    SettingRevision
 from rixiot_libs.camera import create_camera
 from common_libs.db_models import DBOCRSetting, DBThresholdSetting, DBCameraSetting, SensorValue2, SessionClass
 
@@ -81,6 +82,8 @@ def register_camera_setting(settings: list[UICameraSetting], db=Depends(get_db))
             # 設定データが無ければ、設定データをINSERT
             else:
                 CameraSetting.insert(db, setting)
+    # 画像処理タスクに設定の変更を知らせる
+    SettingRevision.bump(db)
 
     if is_success:
         return CameraSetting.get_all(db)
@@ -119,6 +122,27 @@ def get_camera(db=Depends(get_db)):
     return CameraSetting.get_all(db)
 
 
+def load_latest_stored_image(usb_port):
+    """
+    撮影タスクがポートのカメラで最後に保存した画像を読み込む
+    :param usb_port: カメラのポート番号
+    :return: (画像, 撮影時刻の文字列)。保存された画像がない場合は(None, None)
+    """
+    port_directory = f"{config.IMAGE_STORAGE_DIR}/PORT_{usb_port}"
+    try:
+        with os.scandir(port_directory) as entries:
+            timestamps = [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return None, None
+    # 撮影フォルダ名と画像ファイル名は撮影時刻なので、名前順が撮影順になる。新しい撮影フォルダから画像のあるものを探す
+    for timestamp in sorted(timestamps, reverse=True):
+        for image_path in sorted(glob.glob(f"{port_directory}/{timestamp}/*.jpg"), reverse=True):
+            image = cv2.imread(image_path)
+            if image is not None:
+                return image, timestamp
+    return None, None
+
+
 @app.get("/take_an_image/")
 def take_an_image(usb_port):
     """
@@ -130,6 +154,10 @@ def take_an_image(usb_port):
     print(usb_port)
     camera = create_camera(config.CameraType.USB, port=usb_port, fps=config.FPS, buffer_size=1)
     frame = camera.get_image()
+    stored_timestamp = None
+    if frame is None and config.CAMERA_PERSISTENT_SESSION:
+        # 撮影タスクがカメラを開いたままにしている場合は、撮影タスクが最後に保存した画像を使う
+        frame, stored_timestamp = load_latest_stored_image(usb_port)
     if frame is not None:
         timestamp = utils.get_timestamp()
         print(timestamp)
@@ -137,6 +165,9 @@ def take_an_image(usb_port):
         image_directory = f"{config.SETTING_IMAGE_PATH}/PORT_{usb_port}"
         os.makedirs(image_directory, exist_ok=True)
         cv2.imwrite(f"{image_directory}/{timestamp}.jpg", frame)
+        if stored_timestamp is not None:
+            stored_time = utils.to_time_string(utils.to_time_object(stored_timestamp))
+            return f"カメラは撮影タスクが使用中のため、{stored_time}に撮影タスクが保存した画像を使用しました"
         return "画像の撮影に成功しました"
     else:
         return "画像の撮影に失敗しました"
@@ -195,7 +226,7 @@ def add_setting(x1, y1, x2, y2, x3, y3, x4, y4, path):
     path = path.replace("%2F", "/")
     print(f"{config.SETTING_IMAGE_PATH}/{path}")
     img = cv2.imread(filename=f"{config.SETTING_IMAGE_PATH}/{path}")
-    perspective_image = get_perspective_image(perspective_points, img)
+    perspective_image = get_perspective_geometry(perspective_points).warp(img)
     byte_image = OCRSetting.convert_to_byte_image(perspective_image)
     # FastAPIのStreamingResponseを使用して画像をストリーミングレスポンスとして送信
     return StreamingResponse(io.BytesIO(byte_image), media_type="image/png")
@@ -219,6 +250,7 @@ def add_new_setting(data: UIOCRSetting, db=Depends(get_db)):
 
         )
         ThresholdSetting.insert(db, threshold_setting)
+        SettingRevision.bump(db)
         ret = "実行に成功しました。"
     except Exception as e:
         print(e)
@@ -242,6 +274,7 @@ def update_ocr_setting(data: UIOCRSetting2, db=Depends(get_db)):
     ret = ""
     try:
         OCRSetting.update(db, data)
+        SettingRevision.bump(db)
         ret = "実行に成功しました。"
     except Exception:
         ret = "実行に失敗しました。"
@@ -254,6 +287,7 @@ def delete_ocr_setting(id: str, db=Depends(get_db)):
     ret = ""
     try:
         OCRSetting.delete(db, id)
+        SettingRevision.bump(db)
         ret = "実行に成功しました。"
     except Exception:
         ret = "実行に失敗しました。"
@@ -293,6 +327,7 @@ def register_camera_setting(settings: list[UIThresholdSetting], db=Depends(get_d
         # チェックＯＫでCRUD操作
         for setting in settings:
             ThresholdSetting.update(db, setting)
+        SettingRevision.bump(db)
         ret = "実行に成功しました。"
     except Exception:
         ret = "実行に失敗しました"
@@ -321,6 +356,7 @@ def register_reciever_mail_setting(settings: UIMailSetting, db=Depends(get_db)):
             else:
                 print("insert")
                 MailSetting.insert(db, setting)
+    SettingRevision.bump(db)
 
     return ret
 
@@ -338,6 +374,7 @@ def get_mail_setting(db=Depends(get_db)):
 @app.get("/test_ocr_setting/")
 def test_ocr_setting(usb_port: str, image: str, setting_id: str, db=Depends(get_db)):
     print(usb_port, image, setting_id)
+    refresh_setting_snapshot()
     ocr_handler = OCRHandlerFactory().create_ui_ocr_handler(setting_id=setting_id)
     image_path = f"{config.SETTING_IMAGE_PATH}/PORT_{usb_port}/{image}"
     image = load_image(image_path)
@@ -31,6 +31,10 @@ ScopedSessionClass = scoped_session(sessionmaker(bind=engine))
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    # 画面、撮影、画像処理、容量管理の各プロセスが同じファイルを使うため、読み込みが書き込みを待たないWALにする
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT_MS)}")
     cursor.close()
 
 
@@ -112,6 +116,12 @@ class SensorValue2(Base):
     is_modified = Column(Boolean)
 
 
+class DBSettingRevision(Base):
+    __tablename__ = "setting_revision"
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, default=0)
+
+
 # 親テーブルに子テーブルとのリレーションシップを追加（オプショナル）
 DBOCRSetting.children = relationship("DBThresholdSetting", back_populates="parent", cascade="all, delete")
 DBCameraSetting.children = relationship("DBOCRSetting", back_populates="parent", cascade="all, delete")
@@ -0,0 +1,95 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+class DBWriter(threading.Thread):
+    _STOP = object()
+
+    def __init__(self, session_class, commit_delay_sec):
+        """
+        DBへの書き込みを１つのスレッドにまとめ、最初の書き込みからcommit_delay_sec秒の間に
+        渡された書き込みを１つのトランザクションでコミットする
+
+        :param session_class: セッションを作るクラス
+        :param commit_delay_sec: 書き込みをまとめる時間(秒)
+        """
+        super().__init__(daemon=True)
+        self.session_class = session_class
+        self.commit_delay_sec = commit_delay_sec
+        self._queue = queue.Queue()
+
+    def submit(self, operation):
+        """
+        書き込みを待ち行列に入れてすぐに戻る
+        :param operation: セッションを受け取って書き込む関数 operation(session)
+        :return: コミット後にoperationの戻り値が入るFuture
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((operation, future))
+        return future
+
+    def add_all(self, rows):
+        """
+        行を追加する
+        :param rows: 追加するモデルのインスタンスの配列
+        :return: コミット後に完了するFuture
+        """
+        return self.submit(lambda session: session.add_all(rows))
+
+    def stop(self):
+        """
+        待ち行列の書き込みをコミットしてからスレッドを終える
+        """
+        self._queue.put(self._STOP)
+        self.join()
+
+    def run(self):
+        is_stopped = False
+        while not is_stopped:
+            first = self._queue.get()
+            if first is self._STOP:
+                return
+            tasks = [first]
+            deadline = time.monotonic() + self.commit_delay_sec
+            while True:
+                timeout = deadline - time.monotonic()
+                try:
+                    task = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is self._STOP:
+                    is_stopped = True
+                    break
+                tasks.append(task)
+            self.commit(tasks)
+
+    def commit(self, tasks):
+        """
+        書き込みを１つのトランザクションでコミットする。失敗した場合は１件ずつコミットし直し、失敗した書き込みだけを捨てる
+        :param tasks: (operation, future)の配列
+        """
+        try:
+            results = self._commit([operation for operation, _ in tasks])
+        except Exception as e:
+            print(e)
+            if len(tasks) == 1:
+                tasks[0][1].set_exception(e)
+                return
+            for task in tasks:
+                self.commit([task])
+            return
+        for (_, future), result in zip(tasks, results):
+            future.set_result(result)
+
+    def _commit(self, operations):
+        with self.session_class() as session:
+            try:
+                results = [operation(session) for operation in operations]
+                session.commit()
+                return results
+            except Exception as e:
+                # エラーが発生した場合はロールバック
+                session.rollback()
+                raise e
@@ -2,7 +2,7 @@ import json
 import uuid
 
 from sqlalchemy.orm import Session
-from .db_models import DBCameraSetting, DBOCRSetting, DBThresholdSetting, ReceiverMailAddresses
+from .db_models import DBCameraSetting, DBOCRSetting, DBThresholdSetting, ReceiverMailAddresses, DBSettingRevision
 from .data_schema import UICameraSetting, CameraSettingCheck, USBPortResponse, UIOCRSetting, UIOCRSetting2, \
     CameraSettingResponse, BaseThresholdSetting, UIThresholdSetting, UIReceiverSetting, UIReceiverSettingResponse
 import config
@@ -429,6 +429,37 @@ class ThresholdSetting:
         return db.query(DBThresholdSetting).all()
 
 
+class SettingRevision:
+    """
+    設定の版。画面から設定を変更するたびに上げ、画像処理タスクは版が変わった時だけ設定を読み直す
+    """
+    # 版を保持する行のID
+    ROW_ID = 1
+
+    @classmethod
+    def get(cls, db: Session):
+        """
+        現在の設定の版を返す
+        :param db:
+        :return: 設定の版。一度も変更されていない場合は0
+        """
+        revision = db.query(DBSettingRevision.revision).filter(DBSettingRevision.id == cls.ROW_ID).scalar()
+        return revision or 0
+
+    @classmethod
+    def bump(cls, db: Session):
+        """
+        設定の版を１つ上げる。同時に呼ばれても版が上がらないことがないように、DB上で加算する
+        :param db:
+        :return:
+        """
+        updated = db.query(DBSettingRevision).filter(DBSettingRevision.id == cls.ROW_ID).update(
+            {DBSettingRevision.revision: DBSettingRevision.revision + 1}, synchronize_session=False)
+        if not updated:
+            db.add(DBSettingRevision(id=cls.ROW_ID, revision=1))
+        db.commit()
+
+
 class JsonTextStorage:
     """
     テキストファイルにJSONデータを保存、読み込みするクラス
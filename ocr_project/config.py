@@ -20,17 +20,43 @@ USB_PORT_MAPPING = {"1": "1.4", "2": "1.3", "3": "1.2", "4": "1.1", "5": "1.1.3"
 FPS = 30
 BUFFER_SIZE = 1
 STORE_INTERVAL_SEC = 60
+# Trueの場合、撮影タスクはカメラを開いたままにして、撮影スレッドが常に最新のフレームを保持する
+# 全カメラが同時にUSB2のアイソクロナス帯域を予約し続けるので、非圧縮(YUYV)のFPS=30では7台分の帯域が足りない。
+# 開いたままにする場合はMJPEGを要求し、CAMERA_PERSISTENT_FPSで撮影する。MJPEGに対応しないカメラでは無効にする
+CAMERA_PERSISTENT_SESSION = True
+# カメラを開いたままにする場合のフレームレート。予約する帯域を減らすため低くする。
+# CAPTURE_FRAME_INTERVAL_SEC=0の場合、IMAGE_COUNT枚の撮影にIMAGE_COUNT/CAMERA_PERSISTENT_FPS秒かかる
+CAMERA_PERSISTENT_FPS = 5
+# カメラの読み込みに失敗した時に開き直すまでの待ち時間(秒)
+CAMERA_RECONNECT_INTERVAL_SEC = 5
+# カメラを開いてから最初のフレームを待つ時間(秒)
+CAMERA_FIRST_FRAME_TIMEOUT_SEC = 5
+# 撮影する時のフレームの間隔(秒)。0の場合はカメラのフレームレートのまま続けて撮影する
+CAPTURE_FRAME_INTERVAL_SEC = 0
+# Trueの場合、カメラからMJPEGのまま受け取ったフレームを復号も再圧縮もせずに保存し、画像処理で必要な時だけ復号する
+# リングバッファ(FRAME_RING_ENABLED)は使わない
+CAMERA_MJPEG_PASSTHROUGH = False
+# 撮影解像度(幅, 高さ)の候補。カメラの全設定の表示領域を射影変換後の高さ(CANONICAL_DISPLAY_HEIGHT)以上で写せる最小の解像度で撮影する
+# 設定画面の画像と縦横比が同じ候補だけを使う。空の場合はカメラの既定の解像度で撮影する
+# 画面から設定が変更された場合は、撮影タスクを再起動しなくても次の撮影から求め直す
+CAPTURE_RESOLUTIONS = []
 
 # 撮影画像保存フォルダパス
 IMAGE_STORAGE_DIR = "/home/pi/node-red-static/files/images"
 SETTING_IMAGE_PATH = "/home/pi/node-red-static/files/setting_images"
 JSON_SETTING_FILE_DIR = "/home/pi/ocr_project/files/json_settings"
 REGION_IMAGE_DIR = "/home/pi/node-red-static/files/region_images"
+# 撮影完了通知ファイルの保存フォルダパス。画像の保存が終わった撮影フォルダを画像処理に知らせる
+BATCH_NOTIFY_DIR = "/home/pi/ocr_project/files/batch_notifications"
+# MQTTブローカーに送れなかったメッセージの保存ファイルパス
+MQTT_OUTBOX_PATH = "/home/pi/ocr_project/files/mqtt_outbox.sqlite3"
 if os.name == 'nt':
     SETTING_IMAGE_PATH = "../files/setting_images"
     IMAGE_STORAGE_DIR = "../files/images"
     JSON_SETTING_FILE_DIR = "../files/json_settings"
     REGION_IMAGE_DIR = "../files/region_images"
+    BATCH_NOTIFY_DIR = "../files/batch_notifications"
+    MQTT_OUTBOX_PATH = "../files/mqtt_outbox.sqlite3"
 
 # メールアドレス設定の保存ファイルパス
 MAIL_SETTING_PATH = f"{JSON_SETTING_FILE_DIR}/mail_settings.json"
@@ -45,14 +71,63 @@ IMAGE_COUNT = 10
 SS_OCR_CONFIG="-l 7seg --psm 10 --oem 1 -c tessedit_char_whitelist=-0123456789 --dpi 300"
 OCR_CONFIG = "-l eng --psm 10 --oem 1 -c tessedit_char_whitelist=-0123456789 --dpi 300"
 TESSERACT_PATH = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# tesseractの実行方式 "api":モデルをプロセス内に常駐(tesserocrが必要) "process":文字ごとにtesseractを起動
+TESSERACT_ENGINE_MODE = "api"
+# 学習データ(traineddata)のフォルダパス。Noneの場合はtesseractの既定値
+TESSDATA_PATH = None
+if os.name == 'nt':
+    TESSDATA_PATH = os.path.join(os.path.dirname(TESSERACT_PATH), "tessdata")
+# Trueの場合、全桁を横一列に並べた画像を１回のtesseract呼び出しでOCRする
+TESSERACT_LINE_MODE = False
+# 行単位でOCRする時のページ分割モード
+TESSERACT_LINE_PSM = 7
+# 行単位でOCRする時の桁画像の間隔(px)
+TESSERACT_LINE_SPACING = 20
+# Trueの場合、セグメント認識でどちらの２値化方法でも表示パターンに無い桁だけtesseractでOCRする
+OCR_CASCADE_MODE = True
+# グレースケール変換方法 "decolor":cv2.decolor "projection":点灯色と消灯色の差分方向への射影
+GRAY_CONVERSION_METHOD = "decolor"
+# 設定IDごとのグレースケール変換方法。ここに無い設定はGRAY_CONVERSION_METHODを使う
+GRAY_CONVERSION_METHODS = {}
+# 射影変換後の表示領域の高さ(px)。表示の写り方によらず前処理と２値化の処理量を一定にし、tesseractに渡す文字の大きさを揃える
+# Noneの場合は４隅の座標から求めた大きさのまま処理する
+CANONICAL_DISPLAY_HEIGHT = None
+# 設定IDごとの表示領域の高さ(px)。ここに無い設定はCANONICAL_DISPLAY_HEIGHTを使う
+CANONICAL_DISPLAY_HEIGHTS = {}
+# デバッグ用に前処理と２値化の画像を保存するディレクトリ。Noneの場合は保存しない
+OCR_DEBUG_IMAGE_DIR = None
+# 設定ごとのOCRを並列に実行するワーカープロセス数。0の場合は監視スレッドで順番に実行する
+OCR_WORKER_COUNT = 0
+# ワーカープロセスごとのOpenCVとtesseractのスレッド数。ワーカー数との積がコア数を超えないようにする
+OCR_WORKER_CV_THREADS = 1
+# カメラのポートごとに処理待ちにできる撮影フォルダ数。超えた撮影フォルダは処理しない
+OCR_TASK_QUEUE_SIZE = 10
+# Trueの場合、撮影したフレームをポートごとの共有メモリのリングバッファで画像処理に渡し、JPEGファイルは後から保存する
+FRAME_RING_ENABLED = False
+# リングバッファに保持する撮影回数。画像処理中のフレームが次の撮影で上書きされないように2以上にする
+FRAME_RING_BATCH_COUNT = 2
+# リングバッファに格納できるフレームの最大の形状(高さ, 幅, チャネル数)。超えるフレームはJPEGファイルで渡す
+FRAME_RING_MAX_FRAME_SHAPE = (480, 640, 3)
+# リングバッファのフレームが上書きされて画像ファイルから読み込む時に、JPEGファイルの保存を待つ最大時間(秒)
+FRAME_RING_ARCHIVE_WAIT_SEC = 10
 
 ALERT_MAIL_DEAD_BAND_SEC = 5
+# ALERT_MAIL_SEND_LIMIT_PERIOD_SEC秒の間に送るアラートメールの最大数。超えた分は送らない
 ALERT_MAIL_MAX_SEND_LIMIT = 500
+ALERT_MAIL_SEND_LIMIT_PERIOD_SEC = 24 * 60 * 60
+# 最初のアラートからこの時間(秒)の間に発生したアラートを１通のメールにまとめる
+ALERT_MAIL_DIGEST_WINDOW_SEC = 10
+# この時間(秒)以上使っていないSMTP接続は、送信前にNOOPで切断されていないか確認する
+ALERT_MAIL_SMTP_IDLE_CHECK_SEC = 60
 
 SUBJECT = "test"
 
 databese_file = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'sample_db.sqlite3')
 DB_PATH = f"sqlite:///{databese_file}"
+# 他のプロセスが書き込み中の場合に待つ最大時間(ミリ秒)
+DB_BUSY_TIMEOUT_MS = 10000
+# 画像処理の結果をまとめて書き込むまでの待ち時間(秒)。この間に処理が終わった全カメラの結果を１つのトランザクションで書き込む
+DB_GROUP_COMMIT_DELAY_SEC = 5
 
 TARGET_DIRECTORY = '/'
 MAX_PERCENTAGE_OF_DATA = 90
@@ -60,3 +135,16 @@ MQTT_BROKER_IP = "127.0.0.1"
 MQTT_BROKER_PORT = 1883
 MQTT_BROWSER_TOPIC = "mqtt_test"
 MQTT_KEEP_ALIVE_SEC = 60
+# Trueの場合、同じ撮影時刻の全設定の値を１つのMQTTメッセージにまとめて送る
+MQTT_BATCH_MESSAGES = False
+# まとめる時に全カメラの処理を待つ最大時間(秒)
+MQTT_BATCH_TIMEOUT_SEC = 30
+# 再接続に失敗した時の待ち時間(秒)。失敗するたびに最大値まで倍にする
+MQTT_RECONNECT_MIN_DELAY_SEC = 1
+MQTT_RECONNECT_MAX_DELAY_SEC = 120
+# Trueの場合、ブローカーに接続していない間のメッセージをMQTT_OUTBOX_PATHに保存し、再接続後に送る
+MQTT_OUTBOX_ENABLED = True
+# 保存するメッセージの最大数。超えた場合は古いメッセージから捨てる
+MQTT_OUTBOX_MAX_MESSAGES = 10000
+# 再接続後に１回に読み出して送るメッセージ数
+MQTT_OUTBOX_FLUSH_BATCH_SIZE = 100
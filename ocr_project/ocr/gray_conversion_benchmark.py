@@ -0,0 +1,114 @@
+"""
+グレースケール変換方法(cv2.decolorと点灯色・消灯色の差分方向への射影)の処理時間とOCR精度を、
+保存済みの撮影画像で比較する。
+正解値には手動で修正された計測値だけを使う。decolorで読み取ったままの値はdecolorに有利になるため使わない。
+正解値のJSONファイル({"設定ID": {"撮影時刻の文字列": "計測値"}})を指定した場合はそちらを使う
+
+python gray_conversion_benchmark.py [設定ごとの最大画像数] [正解値のJSONファイル]
+"""
+import glob
+import json
+import sys
+import time
+
+sys.path.append('/home/pi/.local/lib/python3.9/site-packages')
+sys.path.append('/home/pi/ocr_project')
+
+import config
+from common_libs.db_models import DBOCRSetting, SensorValue2, ScopedSessionClass
+from image_processing_task import OCRHandlerFactory
+from rixiot_libs.ocr import load_image
+
+GRAY_CONVERSION_METHODS = ["decolor", "projection"]
+
+
+def load_settings():
+    session = ScopedSessionClass()
+    return session.query(DBOCRSetting.id, DBOCRSetting.camera_port).filter(
+        DBOCRSetting.is_setting_disabled == False).all()
+
+
+def load_reference_values(setting_id, reference_file_values=None):
+    """
+    設定IDの正解値を撮影時刻ごとに返す
+    :param setting_id: 設定ID
+    :param reference_file_values: 正解値のJSONファイルの内容。Noneの場合は手動で修正された計測値を使う
+    :return: {撮影時刻の文字列: 計測値}
+    """
+    if reference_file_values is not None:
+        return {timestamp: str(value) for timestamp, value in reference_file_values.get(str(setting_id), {}).items()}
+    session = ScopedSessionClass()
+    rows = session.query(SensorValue2.timestamp, SensorValue2.value).filter(
+        SensorValue2.setting_id == setting_id, SensorValue2.is_modified == True).all()
+    return {timestamp.strftime('%Y%m%d%H%M%S'): value for timestamp, value in rows}
+
+
+def benchmark(setting_id, image_paths, reference_values, gray_conversion_method):
+    """
+    １つのグレースケール変換方法で画像をOCRし、変換時間と計測値の一致数を集計する
+    :param setting_id: 設定ID
+    :param image_paths: 撮影画像のパスの配列
+    :param reference_values: {撮影時刻の文字列: 計測値}
+    :param gray_conversion_method: グレースケール変換方法
+    :return: 集計結果の辞書
+    """
+    ocr_handler = OCRHandlerFactory().create_ocr_handler(setting_id, gray_conversion_method=gray_conversion_method)
+    elapsed_sec = 0.0
+    valid_count = 0
+    compared_count = 0
+    correct_count = 0
+    for image_path in image_paths:
+        image = load_image(image_path)
+        normalized_image = ocr_handler.to_normalized_color_image(image)
+        start = time.perf_counter()
+        ocr_handler.to_gray_image(normalized_image)
+        elapsed_sec += time.perf_counter() - start
+
+        ocr_value = ocr_handler.image_to_string(image)
+        if ocr_value != "NaN":
+            valid_count += 1
+        timestamp = image_path.replace("\\", "/").split("/")[-2]
+        if timestamp in reference_values:
+            compared_count += 1
+            if str(ocr_value) == reference_values[timestamp]:
+                correct_count += 1
+
+    return {"method": gray_conversion_method,
+            "gray_ms": 1000 * elapsed_sec / max(len(image_paths), 1),
+            "valid": valid_count,
+            "compared": compared_count,
+            "correct": correct_count,
+            "images": len(image_paths)}
+
+
+def main():
+    max_image_count = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    reference_file_values = None
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            reference_file_values = json.load(f)
+    results = []
+    for setting_id, camera_port in load_settings():
+        image_paths = sorted(glob.glob(f"{config.IMAGE_STORAGE_DIR}/PORT_{camera_port}/*/*.jpg"))[:max_image_count]
+        if not image_paths:
+            continue
+        reference_values = load_reference_values(setting_id, reference_file_values)
+        for gray_conversion_method in GRAY_CONVERSION_METHODS:
+            result = benchmark(setting_id, image_paths, reference_values, gray_conversion_method)
+            result["setting_id"] = setting_id
+            results.append(result)
+
+    reference_source = sys.argv[2] if reference_file_values is not None else "manually corrected values"
+    print(f"reference: {reference_source}")
+    print("setting_id, method, gray_ms/frame, valid/images, correct/compared")
+    for result in results:
+        print(f"{result['setting_id']}, {result['method']}, {result['gray_ms']:.3f}, "
+              f"{result['valid']}/{result['images']}, {result['correct']}/{result['compared']}")
+    for gray_conversion_method in GRAY_CONVERSION_METHODS:
+        method_results = [result for result in results if result["method"] == gray_conversion_method]
+        print(f"{gray_conversion_method}: correct {sum(result['correct'] for result in method_results)}"
+              f"/{sum(result['compared'] for result in method_results)} compared images")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,190 @@
+import concurrent.futures
 import glob
 import json
+import multiprocessing
 import os
+import queue
+import signal
 import sys
+import threading
 
 sys.path.append('/home/pi/.local/lib/python3.9/site-packages')
 sys.path.append('/home/pi/ocr_project')
+import config
+
+# OCRワーカープロセスのtesseractのスレッド数を制限する。libgompは読み込まれた時に環境変数を読むので、
+# tesserocrとcv2を読み込む前に設定しておき、ワーカープロセスにそのまま引き継ぐ
+if config.OCR_WORKER_COUNT > 0:
+    os.environ.setdefault("OMP_THREAD_LIMIT", str(config.OCR_WORKER_CV_THREADS))
+
 import time
 import numpy as np
 import cv2
 
 from watchdog.events import FileSystemEventHandler
-from watchdog.observers.polling import PollingObserver
+from watchdog.observers import Observer
 
-import config
 from common_libs.db_models import DBOCRSetting, DBThresholdSetting, SensorValue2, ScopedSessionClass, DBCameraSetting, \
-    ReceiverMailAddresses
-from common_libs.models import JsonTextStorage
-from common_libs.schema import Coordinate
+    ReceiverMailAddresses, SessionClass, engine
+from common_libs.models import JsonTextStorage, SettingRevision
 from common_libs import utils
+from rixiot_libs.batch import is_batch_notification, read_batch_notification, list_batch_notifications, \
+    remove_batch_notification, wait_archive_complete
 from rixiot_libs.event import ValueEventCalculator, EventPolicy
-from rixiot_libs.mail import EmailMessagePool, EmailMessageCreator, EmailSender
-from rixiot_libs.ocr import OCRHandler, TesseractOCREngine, SegmentOCREngine, DecimalPointOCREngine
-from rixiot_libs.mqtt_factory import MQTTClientFactory, on_connect, on_disconnect
+from rixiot_libs.frame_ring import read_ring_frames, is_ring_reference_current
+from common_libs.db_writer import DBWriter
+from rixiot_libs.mail import EmailDispatcher, EmailMessagePool, EmailMessageCreator, EmailSender
+from rixiot_libs.ocr import OCRHandler, TesseractOCREngine, TesseractAPIOCREngine, SegmentOCREngine, \
+    DecimalPointOCREngine, CascadeStatistics, FrameCache, compile_display_geometry, read_image_size, \
+    calculate_capture_resolution
+from rixiot_libs.mqtt_factory import MQTTClientFactory, MQTTOutbox, MQTTPublisher, MQTTMessageBatcher, on_connect, on_disconnect
+
+
+class SettingSnapshot:
+    def __init__(self):
+        """
+        DBの設定をまとめて読み込んで保持し、画面から設定が変更されて設定の版が上がった時だけ読み直す。
+        設定から作るイベント判定やメール送信のオブジェクトも版ごとに一度だけ作って使い回す
+        """
+        self.revision = None
+        self._ocr_settings = {}
+        self._threshold_settings = {}
+        self._camera_settings = {}
+        self._receiver_mail_addresses = []
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, is_forced=False):
+        """
+        設定の版が変わっていれば設定を読み直す
+        :param is_forced: Trueの場合は版が同じでも読み直す
+        :return: 読み直した場合はTrue
+        """
+        session = SessionClass()
+        try:
+            revision = SettingRevision.get(session)
+            with self._lock:
+                if revision == self.revision and not is_forced:
+                    return False
+                # セッションを閉じた後も属性を参照できるように、読み込んだ行をそのまま保持する
+                self._ocr_settings = {setting.id: setting for setting in session.query(DBOCRSetting).all()}
+                self._threshold_settings = {setting.setting_id: setting
+                                            for setting in session.query(DBThresholdSetting).all()}
+                self._camera_settings = {str(setting.usb_port): setting
+                                         for setting in session.query(DBCameraSetting).all()}
+                self._receiver_mail_addresses = session.query(ReceiverMailAddresses).all()
+                self._objects = {}
+                self.revision = revision
+                print(f"setting revision:{revision}")
+                return True
+        finally:
+            session.close()
+
+    def get_ocr_setting(self, setting_id):
+        """
+        OCR設定を返す。スナップショットに無い場合は読み直す
+        :param setting_id: 設定ID
+        :return: DBOCRSetting
+        """
+        if setting_id not in self._ocr_settings:
+            self.refresh(is_forced=True)
+        return self._ocr_settings[setting_id]
+
+    def get_setting_ids(self, camera_port=None):
+        """
+        設定IDの配列を返す
+        :param camera_port: カメラのポート番号。Noneの場合は全カメラの設定
+        :return: 設定IDの配列
+        """
+        if self.revision is None:
+            self.refresh()
+        return [setting_id for setting_id, setting in self._ocr_settings.items()
+                if camera_port is None or str(setting.camera_port) == str(camera_port)]
+
+    def get_threshold_setting(self, setting_id):
+        """
+        閾値設定を返す
+        :param setting_id: 設定ID
+        :return: DBThresholdSetting。無い場合はNone
+        """
+        if self.revision is None:
+            self.refresh()
+        return self._threshold_settings.get(setting_id)
+
+    def get_camera_setting(self, camera_port):
+        """
+        カメラ設定を返す
+        :param camera_port: カメラのポート番号
+        :return: DBCameraSetting。無い場合はNone
+        """
+        if self.revision is None:
+            self.refresh()
+        return self._camera_settings.get(str(camera_port))
+
+    def get_camera_ports(self):
+        """
+        有効な設定があるカメラのポート番号の集合を返す
+        :return: ポート番号の文字列の集合
+        """
+        if self.revision is None:
+            self.refresh()
+        return {str(setting.camera_port) for setting in self._ocr_settings.values() if not setting.is_setting_disabled}
+
+    def get_receiver_mail_addresses(self):
+        """
+        受信者アドレス設定の配列を返す
+        :return: ReceiverMailAddressesの配列
+        """
+        if self.revision is None:
+            self.refresh()
+        return self._receiver_mail_addresses
+
+    def get_object(self, key, create):
+        """
+        設定から作るオブジェクトを返す。現在の版で初めて使う場合だけ作る
+        :param key: オブジェクトを区別するキー
+        :param create: オブジェクトを作る関数
+        :return: オブジェクト
+        """
+        with self._lock:
+            objects = self._objects
+            if key in objects:
+                return objects[key]
+        created = create()
+        with self._lock:
+            # 作っている間に読み直した場合は、古い版のオブジェクトを新しい版に混ぜない
+            if objects is self._objects:
+                objects.setdefault(key, created)
+                return objects[key]
+        return created
+
+
+# プロセスごとに保持する設定のスナップショット
+_setting_snapshot = SettingSnapshot()
+
+
+def refresh_setting_snapshot():
+    """
+    設定の版が変わっていれば、プロセスの設定のスナップショットを読み直す
+    :return: 読み直した場合はTrue
+    """
+    return _setting_snapshot.refresh()
 
 
 def load_setting_ids(camera_port):
-    session = ScopedSessionClass()
-    settings = session.query(DBOCRSetting.id).filter(DBOCRSetting.camera_port == camera_port).all()
-    id_list = [setting[0] for setting in settings]
-    return id_list
+    return _setting_snapshot.get_setting_ids(camera_port)
 
 
 def get_setting_ids():
-    session = ScopedSessionClass()
-    setting_ids = [arr[0] for arr in session.query(DBOCRSetting.id).all()]
-    return setting_ids
+    return _setting_snapshot.get_setting_ids()
 
 
 class OCRHandlerFactory:
+    # 設定IDごとのカスケード方式の集計。ハンドラを作り直しても集計を引き継ぐ
+    cascade_statistics = {}
 
     def load_ocr_setting(self, setting_id):
-        session = ScopedSessionClass()
-        setting = session.query(DBOCRSetting).filter(DBOCRSetting.id == setting_id).all()[0]
-        # print(session.query(DBOCRSetting).filter(DBOCRSetting.id == setting_id).all()[0].segment_point_setting)
-        return setting
+        return _setting_snapshot.get_ocr_setting(setting_id)
 
     def create_ocr_handlers(self):
         setting_ids = get_setting_ids()
@@ -51,13 +192,11 @@ class OCRHandlerFactory:
         return handlers
 
     def create_ui_ocr_handler(self, setting_id):
-        ocr_points = self._calculate_ocr_points(setting_id)
-        print(ocr_points)
-        display_region = self._load_display_region(setting_id)
-        segment_regions = self._load_segment_regions(setting_id)
+        display_geometry = self._create_display_geometry(setting_id)
+        print(display_geometry.ocr_points)
         on_color = self._load_on_color(setting_id)
         off_color = self._load_off_color(setting_id)
-        decimal_point_ocr_engine = self._create_decimal_point_ocr_engine(setting_id)
+        decimal_point_ocr_engine = self._create_decimal_point_ocr_engine(setting_id, display_geometry)
         is_segment_points_detection = self._load_is_segment_points_detection(setting_id)
         tesseract_ocr_engine = self._create_tesseract_ocr_engine(is_segment_points_detection)
         is_off_segment_color = self._load_is_off_segment_color(setting_id)
@@ -68,20 +207,20 @@ class OCRHandlerFactory:
         print(tesseract_ocr_engine._ocr_config, setting_id)
         return OCRHandler(
             tesseract_ocr_engine=tesseract_ocr_engine, segment_ocr_engine=segment_ocr_engine,
-            decimal_point_ocr_engine=decimal_point_ocr_engine, ocr_points=ocr_points, display_region=display_region,
-            segment_regions=segment_regions, on_color=on_color, off_color=off_color,
-            is_off_segment_color=is_off_segment_color)
+            decimal_point_ocr_engine=decimal_point_ocr_engine, display_geometry=display_geometry,
+            on_color=on_color, off_color=off_color, is_off_segment_color=is_off_segment_color, is_tesseract_line_mode=config.TESSERACT_LINE_MODE,
+            tesseract_line_spacing=config.TESSERACT_LINE_SPACING, is_cascade_mode=config.OCR_CASCADE_MODE,
+            gray_conversion_method=self._load_gray_conversion_method(setting_id),
+            debug_image_dir=config.OCR_DEBUG_IMAGE_DIR)
 
-    def create_ocr_handler(self, setting_id):
+    def create_ocr_handler(self, setting_id, gray_conversion_method=None, source_scale=1.0):
         setting = self.load_ocr_setting(setting_id)
         if setting.is_setting_disabled:
             return None
-        ocr_points = self._calculate_ocr_points(setting_id)
-        display_region = self._load_display_region(setting_id)
-        segment_regions = self._load_segment_regions(setting_id)
+        display_geometry = self._create_display_geometry(setting_id, source_scale)
         on_color = self._load_on_color(setting_id)
         off_color = self._load_off_color(setting_id)
-        decimal_point_ocr_engine = self._create_decimal_point_ocr_engine(setting_id)
+        decimal_point_ocr_engine = self._create_decimal_point_ocr_engine(setting_id, display_geometry)
         is_segment_points_detection = self._load_is_segment_points_detection(setting_id)
         tesseract_ocr_engine = self._create_tesseract_ocr_engine(is_segment_points_detection)
         is_off_segment_color = self._load_is_off_segment_color(setting_id)
@@ -92,12 +231,82 @@ class OCRHandlerFactory:
         print(tesseract_ocr_engine._ocr_config, setting_id)
         return OCRHandler(
             tesseract_ocr_engine=tesseract_ocr_engine, segment_ocr_engine=segment_ocr_engine,
-            decimal_point_ocr_engine=decimal_point_ocr_engine, ocr_points=ocr_points, display_region=display_region,
-            segment_regions=segment_regions, on_color=on_color, off_color=off_color,is_off_segment_color=is_off_segment_color)
+            decimal_point_ocr_engine=decimal_point_ocr_engine, display_geometry=display_geometry,
+            on_color=on_color, off_color=off_color,is_off_segment_color=is_off_segment_color,
+            is_tesseract_line_mode=config.TESSERACT_LINE_MODE, tesseract_line_spacing=config.TESSERACT_LINE_SPACING,
+            is_cascade_mode=config.OCR_CASCADE_MODE,
+            cascade_statistics=self.cascade_statistics.setdefault(setting_id, CascadeStatistics()),
+            gray_conversion_method=gray_conversion_method or self._load_gray_conversion_method(setting_id),
+            debug_image_dir=config.OCR_DEBUG_IMAGE_DIR)
+
+    def _create_display_geometry(self, setting_id, source_scale=1.0):
+        setting = self.load_ocr_setting(setting_id)
+        return compile_display_geometry(
+            perspective_transformation_setting=setting.perspective_transformation_setting,
+            segment_region_settings=setting.segment_region_settings,
+            segment_recognition_points=setting.segment_recognition_points,
+            decimal_point_setting=setting.decimal_point_setting,
+            canonical_height=self._load_canonical_display_height(setting_id),
+            source_scale=source_scale)
+
+    def load_source_reduction(self, setting_id, source_scale=1.0):
+        """
+        設定の表示領域の出力の大きさに対して、フレームを縮小して読み込める縮小率を返す
+        :param setting_id: 設定ID
+        :param source_scale: 設定画面の画像に対するフレームの倍率
+        :return: 縮小率
+        """
+        return self._create_display_geometry(setting_id, source_scale).perspective.reduction
+
+    def load_reference_size(self, setting_id):
+        """
+        設定の座標を指定した設定画面の画像の大きさを返す
+        :param setting_id: 設定ID
+        :return: (幅, 高さ)。設定画面の画像が無い場合はNone
+        """
+        setting = self.load_ocr_setting(setting_id)
+        if not setting.setting_image:
+            return None
+        return read_image_size(f"{config.SETTING_IMAGE_PATH}/PORT_{setting.camera_port}/{setting.setting_image}")
+
+    def load_source_scale(self, setting_id, frame_size):
+        """
+        設定画面の画像に対するフレームの倍率を返す。撮影解像度が設定画面の画像と同じ場合は1
+        :param setting_id: 設定ID
+        :param frame_size: 縮小せずに読み込んだフレームの大きさ(幅, 高さ)
+        :return: 倍率
+        """
+        reference_size = self.load_reference_size(setting_id)
+        if frame_size is None or reference_size is None or tuple(frame_size) == tuple(reference_size):
+            return 1.0
+        scale = frame_size[0] / reference_size[0]
+        # 縦横比が異なる場合は座標を同じ倍率で合わせられない。丸めによる1px以内の差は許す
+        if abs(frame_size[1] - reference_size[1] * scale) > 1:
+            print(f"setting {setting_id}: frame size {tuple(frame_size)} does not have the aspect ratio of "
+                  f"the setting image {tuple(reference_size)}. use scale 1.0")
+            return 1.0
+        return round(scale, 6)
+
+    def load_capture_resolution(self, camera_port, resolutions):
+        """
+        カメラの有効な全設定の表示領域を写せる最小の撮影解像度を返す
+        :param camera_port: カメラのポート番号
+        :param resolutions: 撮影解像度(幅, 高さ)の候補の配列
+        :return: 撮影解像度(幅, 高さ)。候補に適したものが無い場合や、設定画面の画像の大きさが揃っていない場合はNone
+        """
+        setting_ids = [setting_id for setting_id in load_setting_ids(camera_port)
+                       if not self.load_ocr_setting(setting_id).is_setting_disabled]
+        reference_sizes = {self.load_reference_size(setting_id) for setting_id in setting_ids}
+        if not resolutions or len(reference_sizes) != 1 or None in reference_sizes:
+            return None
+        return calculate_capture_resolution(
+            [json.loads(self.load_ocr_setting(setting_id).perspective_transformation_setting)
+             for setting_id in setting_ids],
+            reference_sizes.pop(), resolutions,
+            [self._load_canonical_display_height(setting_id) for setting_id in setting_ids])
 
-    def _load_display_region(self, setting_id):
-        display_region = json.loads(self.load_ocr_setting(setting_id).perspective_transformation_setting)
-        return display_region
+    def _load_canonical_display_height(self, setting_id):
+        return config.CANONICAL_DISPLAY_HEIGHTS.get(setting_id, config.CANONICAL_DISPLAY_HEIGHT)
 
     def _load_on_color(self, setting_id):
         on_color = json.loads(self.load_ocr_setting(setting_id).segment_on_color)
@@ -110,6 +319,9 @@ class OCRHandlerFactory:
         off_color = [off_color["b"], off_color["g"], off_color["r"]]
         return off_color
 
+    def _load_gray_conversion_method(self, setting_id):
+        return config.GRAY_CONVERSION_METHODS.get(setting_id, config.GRAY_CONVERSION_METHOD)
+
     def _calculate_segment_color(self, setting_id):
         on_color = self._load_on_color(setting_id)
         off_color = self._load_off_color(setting_id)
@@ -124,49 +336,202 @@ class OCRHandlerFactory:
         else:
             ocr_config = config.OCR_CONFIG
 
-        return TesseractOCREngine(ocr_config=ocr_config, tesseract_path=tesseract_path)
+        if config.TESSERACT_ENGINE_MODE == "api":
+            try:
+                return TesseractAPIOCREngine(ocr_config=ocr_config, tessdata_path=config.TESSDATA_PATH,
+                                             line_psm=config.TESSERACT_LINE_PSM)
+            except ImportError as e:
+                print(f"{e}。tesseractをプロセス起動で実行します")
+        return TesseractOCREngine(ocr_config=ocr_config, tesseract_path=tesseract_path,
+                                  line_psm=config.TESSERACT_LINE_PSM)
 
     def _create_segment_ocr_engine(self, setting_id):
         segment_color = self._calculate_segment_color(setting_id)
         return SegmentOCREngine(segment_color=segment_color)
 
-    def _create_decimal_point_ocr_engine(self, setting_id):
-        ocr_points = json.loads(self.load_ocr_setting(setting_id).decimal_point_setting)
-        ocr_points = [Coordinate(x=int(point["decimal_x"]), y=int(point["decimal_y"])) for point in ocr_points]
+    def _create_decimal_point_ocr_engine(self, setting_id, display_geometry):
         decimal_point_positions = json.loads(self.load_ocr_setting(setting_id).decimal_exponents)
-        return DecimalPointOCREngine(ocr_points=ocr_points, decimal_point_positions=decimal_point_positions)
-
-    def _load_segment_regions(self, setting_id):
-        segment_region_settings = json.loads(self.load_ocr_setting(setting_id).segment_region_settings)
-        return segment_region_settings
+        return DecimalPointOCREngine(ocr_points=display_geometry.decimal_points,
+                                     decimal_point_positions=decimal_point_positions)
 
     def _load_is_segment_points_detection(self, setting_id):
         return self.load_ocr_setting(setting_id).is_segment_points_detection
 
-    def _load_ocr_points(self, setting_id):
-        return json.loads(self.load_ocr_setting(setting_id).segment_recognition_points)
-
-    def _calculate_ocr_points(self, setting_id):
-        segment_regions = self._load_segment_regions(setting_id)
-        ocr_points = self._load_ocr_points(setting_id)
-        int_ocr_points = []
-        # print(ocr_points)
-
-        for segment_region, ocr_point in zip(segment_regions, ocr_points):
-            print(ocr_point)
-            offset_x = int(segment_region["region_left_x"])
-            offset_y = int(segment_region["region_left_y"])
-            int_ocr_points.append(
-                [Coordinate(x=int(point[0]) - offset_x, y=int(point[1]) - offset_y) for point in ocr_point])
-        print(int_ocr_points)
-        return int_ocr_points
-
     def _load_is_off_segment_color(self, setting_id):
         ret = self.load_ocr_setting(setting_id).is_off_segment_color
         print(ret)
         return ret
 
 
+class OCRHandlerCache:
+    def __init__(self):
+        """
+        設定IDごとにOCRHandlerを保持し、DBの設定内容が変わった場合だけ作り直す。
+        射影変換の座標表やtesseractの初期化、前処理の作業領域をバッチをまたいで使い回す
+        """
+        self._ocr_handlers = {}
+
+    def get(self, setting_id, source_scale=1.0):
+        """
+        設定IDのOCRHandlerを返す
+        :param setting_id: 設定ID
+        :param source_scale: 設定画面の画像に対するフレームの倍率
+        :return: OCRHandler。設定が無効の場合はNone
+        """
+        setting = OCRHandlerFactory().load_ocr_setting(setting_id)
+        signature = tuple(getattr(setting, column.name) for column in setting.__table__.columns) + (source_scale,)
+        cached = self._ocr_handlers.get(setting_id)
+        if cached is None or cached[0] != signature:
+            cached = (signature, OCRHandlerFactory().create_ocr_handler(setting_id, source_scale=source_scale))
+            self._ocr_handlers[setting_id] = cached
+        return cached[1]
+
+
+# プロセスごとに保持するOCRHandler
+_ocr_handler_cache = OCRHandlerCache()
+
+
+def initialize_ocr_worker(cv_threads):
+    """
+    OCRワーカープロセスの初期化。プロセス数とOpenCVのスレッド数の積がコア数を超えないようにする。
+    tesseractのスレッド数はモジュールの読み込み前に設定したOMP_THREAD_LIMITで制限する
+    :param cv_threads: ワーカープロセスごとのOpenCVのスレッド数
+    """
+    cv2.setNumThreads(cv_threads)
+    # forkで起動された場合に備えて、親プロセスから引き継いだDB接続は使わない。親プロセスの接続を閉じないようにclose=Falseで捨てる
+    engine.dispose(close=False)
+
+
+def wait_frame_archive(images):
+    """
+    リングバッファに無いフレームを画像ファイルから読み込む前に、撮影タスクのJPEGファイルの保存が終わるのを待つ
+    :param images: フレームの画像ファイルのパスの配列
+    """
+    if images:
+        wait_archive_complete(os.path.dirname(images[0]), config.FRAME_RING_ARCHIVE_WAIT_SEC)
+
+
+def create_frame_cache(images, reduction, ring_reference=None):
+    """
+    １回の撮影のフレームを設定間で共有するFrameCacheを作る。
+    フレームは呼び出し側が参照を手放すと解放されるので、次の撮影まで保持しない
+    :param images: フレームの画像ファイルのパスの配列
+    :param reduction: 読み込み時の縮小率
+    :param ring_reference: フレームを格納したリングバッファの参照。Noneの場合は画像ファイルから読み込む
+    :return: FrameCache
+    """
+    if ring_reference is None:
+        return FrameCache(images, reduction=reduction)
+    # リングバッファのフレームは縮小せずに格納されている
+    frames = read_ring_frames(ring_reference)
+    if len(frames) < len(images):
+        wait_frame_archive(images)
+    return FrameCache(images, reduction=1, frames=frames)
+
+
+def load_frame_size(images, ring_reference=None):
+    """
+    撮影したフレームの大きさを、画素を復号せずに調べる
+    :param images: フレームの画像ファイルのパスの配列
+    :param ring_reference: フレームを格納したリングバッファの参照。Noneの場合は画像ファイルから調べる
+    :return: (幅, 高さ)。調べられない場合はNone
+    """
+    if ring_reference is not None:
+        for frame in read_ring_frames(ring_reference).values():
+            return frame.shape[1], frame.shape[0]
+        wait_frame_archive(images)
+    for image_path in images:
+        frame_size = read_image_size(image_path)
+        if frame_size is not None:
+            return frame_size
+    return None
+
+
+def calculate_ocr_result(setting_id, images, reduction, ring_reference=None, source_scale=1.0, frame_cache=None):
+    """
+    １設定分のOCRを行い、多数決で選ばれたフレームの表示領域の画像を保存する。ワーカープロセスでも実行される
+    :param setting_id: 設定ID
+    :param images: フレームの画像ファイルのパスの配列
+    :param reduction: フレームの読み込み時の縮小率
+    :param ring_reference: フレームを格納したリングバッファの参照。Noneの場合は画像ファイルから読み込む
+    :param source_scale: 設定画面の画像に対するフレームの倍率
+    :param frame_cache: 同じ撮影の設定間で共有するFrameCache。Noneの場合はこの呼び出しの間だけ読み込む
+    :return: (OCR値, 選ばれた画像ファイルのパス, 表示領域の画像の保存先)。設定が無効の場合と、フレームを１枚も読み込めない場合はNone
+    """
+    # ワーカープロセスは設定のスナップショットを別に持つので、ここで版を確認する
+    _setting_snapshot.refresh()
+    ocr_handler = _ocr_handler_cache.get(setting_id, source_scale)
+    if ocr_handler is None:
+        return None
+
+    if frame_cache is None:
+        frame_cache = create_frame_cache(images, reduction, ring_reference)
+    ocr_value, image_path = ocr_handler.calculate_ocr_value(images, frame_cache=frame_cache)
+    if image_path is None:
+        print(f"setting {setting_id}: no frame could be loaded")
+        return None
+    image_name = os.path.basename(image_path)
+    print(image_name)
+    save_dir = f"{config.REGION_IMAGE_DIR}/{setting_id}"
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = f"{save_dir}/{image_name}"
+    print(save_path, image_path)
+    ocr_handler.save(image_path=image_path, save_path=save_path)
+    return ocr_value, image_path, save_path
+
+
+def create_ocr_executor():
+    """
+    設定ごとのOCRを並列に実行するプロセスプールを作る。
+    ワーカーは監視やMQTT、DB書き込みのスレッドが動いているプロセスからforkせず、forkserver(無い場合はspawn)で起動する。
+    forkすると他のスレッドが持っていたロックを持ったままの状態で子プロセスが止まることがある
+    :return: ProcessPoolExecutor。ワーカー数が0の場合はNone
+    """
+    if config.OCR_WORKER_COUNT <= 0:
+        return None
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return concurrent.futures.ProcessPoolExecutor(max_workers=config.OCR_WORKER_COUNT,
+                                                  mp_context=multiprocessing.get_context(start_method),
+                                                  initializer=initialize_ocr_worker,
+                                                  initargs=(config.OCR_WORKER_CV_THREADS,))
+
+
+def create_mqtt_outbox():
+    """
+    ブローカーに送れなかったメッセージを保存するoutboxを作る
+    :return: MQTTOutbox。使わない場合はNone
+    """
+    if not config.MQTT_OUTBOX_ENABLED:
+        return None
+    os.makedirs(os.path.dirname(config.MQTT_OUTBOX_PATH), exist_ok=True)
+    return MQTTOutbox(config.MQTT_OUTBOX_PATH, max_count=config.MQTT_OUTBOX_MAX_MESSAGES)
+
+
+def create_mail_dispatcher():
+    """
+    アラートメールを別スレッドでまとめて送るEmailDispatcherを作って開始する
+    :return: EmailDispatcher
+    """
+    mail_dispatcher = EmailDispatcher(
+        load_email_sender=lambda: _setting_snapshot.get_object("email_sender",
+                                                               EmailSenderFactory().create_email_sender),
+        digest_window_sec=config.ALERT_MAIL_DIGEST_WINDOW_SEC,
+        max_send_count=config.ALERT_MAIL_MAX_SEND_LIMIT,
+        send_count_period_sec=config.ALERT_MAIL_SEND_LIMIT_PERIOD_SEC)
+    mail_dispatcher.start()
+    return mail_dispatcher
+
+
+def create_db_writer():
+    """
+    全カメラの画像処理の結果をまとめて書き込むDBWriterを作って開始する
+    :return: DBWriter
+    """
+    db_writer = DBWriter(session_class=SessionClass, commit_delay_sec=config.DB_GROUP_COMMIT_DELAY_SEC)
+    db_writer.start()
+    return db_writer
+
+
 class EventCalculatorFactory:
 
     def create_event_calculators(self):
@@ -175,10 +540,7 @@ class EventCalculatorFactory:
         return handlers
 
     def load_th_setting(self, setting_id):
-        session = ScopedSessionClass()
-
-        setting = session.query(DBThresholdSetting).filter(DBThresholdSetting.setting_id == setting_id).first()
-        return setting
+        return _setting_snapshot.get_threshold_setting(setting_id)
 
     def create_event_calculator(self, setting_id):
         setting = self.load_th_setting(setting_id)
@@ -193,15 +555,24 @@ class EventCalculatorFactory:
 
 class FileEventHandler:
 
-    def __init__(self, directory=".", handler=FileSystemEventHandler()):
-        self.observer = PollingObserver()
+    def __init__(self, directory=".", handler=FileSystemEventHandler(), recursive=False):
+        # Linuxではinotifyでイベントを受け取るので、フォルダ内を定期的に走査しない
+        self.observer = Observer()
         self.handler = handler
         self.directory = directory
+        self.recursive = recursive
 
-    def run(self):
-        self.observer.schedule(self.handler, self.directory, recursive=True)
+    def start(self):
+        """
+        フォルダの監視を開始する。開始後に置かれたファイルのイベントは取りこぼさない
+        """
+        self.observer.schedule(self.handler, self.directory, recursive=self.recursive)
         self.observer.start()
         print(f"MyWatcher Running in {self.directory}")
+
+    def run(self):
+        if not self.observer.is_alive():
+            self.start()
         try:
             while True:
                 time.sleep(1)
@@ -223,16 +594,12 @@ class EmailMessageFactory:
         return handlers
 
     def load_camera_name(self, setting_id):
-        session = ScopedSessionClass()
-        setting = session.query(DBOCRSetting).filter(DBOCRSetting.id == setting_id).first()
-        camera_port = setting.camera_port
-        camera_setting = session.query(DBCameraSetting).filter(DBCameraSetting.usb_port == camera_port).first()
+        camera_port = _setting_snapshot.get_ocr_setting(setting_id).camera_port
+        camera_setting = _setting_snapshot.get_camera_setting(camera_port)
         return camera_setting.name
 
     def load_setting_name(self, setting_id):
-        session = ScopedSessionClass()
-        setting = session.query(DBOCRSetting).filter(DBOCRSetting.id == setting_id).first()
-        return setting.setting_name
+        return _setting_snapshot.get_ocr_setting(setting_id).setting_name
 
 
 class EmailSenderFactory:
@@ -242,9 +609,8 @@ class EmailSenderFactory:
         return file.load()
 
     def load_receiver_email_address(self):
-        session = ScopedSessionClass()
-        receiver_emails = [arr[0] for arr in session.query(ReceiverMailAddresses.address).filter(
-            ReceiverMailAddresses.is_disable == False).all()]
+        receiver_emails = [receiver.address for receiver in _setting_snapshot.get_receiver_mail_addresses()
+                           if receiver.is_disable is False]
         print(receiver_emails)
         return ', '.join(receiver_emails) if receiver_emails else None
 
@@ -261,7 +627,8 @@ class EmailSenderFactory:
                            sender_email=sender_address,
                            sender_password=sender_password,
                            receiver_emails=receiver_emails,
-                           subject=config.SUBJECT
+                           subject=config.SUBJECT,
+                           idle_check_sec=config.ALERT_MAIL_SMTP_IDLE_CHECK_SEC
                            )
 
 
@@ -277,59 +644,184 @@ class EventPolicyFactory:
         return handlers
 
 
+class PortTaskDispatcher:
+    def __init__(self, task, max_queue_size):
+        """
+        撮影分の処理をカメラのポートごとの上限付きキューに入れ、ポートごとのスレッドで順番に処理する。
+        異なるポートの撮影分は並行して処理される
+
+        :param task: 撮影分を処理する関数 task(item)
+        :param max_queue_size: ポートごとのキューの上限
+        """
+        self._task = task
+        self._max_queue_size = max_queue_size
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def dispatch(self, port, item):
+        """
+        撮影分をポートのキューに入れてすぐに戻る。キューが一杯の場合は破棄する
+        :param port: カメラのポート番号
+        :param item: taskに渡す撮影分の情報
+        :return: キューに入れた場合はTrue
+        """
+        try:
+            self._get_queue(port).put_nowait(item)
+        except queue.Full:
+            print(f"warning: task queue of PORT_{port} is full. {item} is skipped")
+            return False
+        return True
+
+    def _get_queue(self, port):
+        with self._lock:
+            task_queue = self._queues.get(port)
+            if task_queue is None:
+                task_queue = queue.Queue(maxsize=self._max_queue_size)
+                self._queues[port] = task_queue
+                threading.Thread(target=self._run, args=(task_queue,), name=f"ocr-port-{port}", daemon=True).start()
+            return task_queue
+
+    def _run(self, task_queue):
+        while True:
+            item = task_queue.get()
+            try:
+                self._task(item)
+            except Exception as e:
+                print(f"error: {item} {e}")
+            finally:
+                task_queue.task_done()
+
+
 class OCRProcessHandler(FileSystemEventHandler):
 
     def __init__(self, event_policies, message_pool, mqtt_client, mqtt_broker_ip, mqtt_broker_port, mqtt_keep_alive,
-                 mqtt_topic):
+                 mqtt_topic, ocr_executor=None, mqtt_outbox=None, mail_dispatcher=None,
+                 db_writer=None):
         self.event_policies = event_policies,
+        self.ocr_executor = ocr_executor
         self.message_pool = message_pool
+        self.mail_dispatcher = mail_dispatcher
+        self.db_writer = db_writer
         self.mqtt_client = mqtt_client
         self.mqtt_broker_ip = mqtt_broker_ip
         self.mqtt_broker_port = mqtt_broker_port
         self.mqtt_keep_alive = mqtt_keep_alive
         self.mqtt_topic = mqtt_topic
+        self.task_dispatcher = PortTaskDispatcher(task=self.process_batch_notification,
+                                                  max_queue_size=config.OCR_TASK_QUEUE_SIZE)
+        # キューに入れた未処理の撮影完了通知ファイル
+        self._dispatched_notifications = set()
+        self._notification_lock = threading.Lock()
+        # ブローカーとの接続を保ち、ポートごとのスレッドで共有する。接続していない間のメッセージはmqtt_outboxに保存する
+        self.mqtt_publisher = MQTTPublisher(client=mqtt_client, broker_ip=mqtt_broker_ip, broker_port=mqtt_broker_port,
+                                            keep_alive=mqtt_keep_alive, topic=mqtt_topic, outbox=mqtt_outbox,
+                                            flush_batch_size=config.MQTT_OUTBOX_FLUSH_BATCH_SIZE)
+        self.mqtt_message_batcher = MQTTMessageBatcher(publish=self.send_batched_message_to_browser,
+                                                       load_expected_ports=_setting_snapshot.get_camera_ports,
+                                                       timeout_sec=config.MQTT_BATCH_TIMEOUT_SEC)
+        # ポートごとのスレッドで共有するアラートメールのプール
+        self._alert_lock = threading.Lock()
         print(self.event_policies)
         print(type(self.event_policies))
 
     def connect_mqtt(self):
-        self.mqtt_client.connect(self.mqtt_broker_ip, self.mqtt_broker_port, self.mqtt_keep_alive)
+        self.mqtt_publisher.start()
 
     def on_created(self, event):
-        directory = event.src_path.replace(os.sep, '/')
-        print(directory)
-        print(os.path.isdir(directory))
-        timestamp = os.path.basename(directory)
-        print(timestamp)
-        if os.path.isdir(directory) and timestamp.isdecimal():
-            time.sleep(10)
-            self.do_tasks(directory)
+        self.dispatch_batch_notification(event.src_path)
+
+    def on_moved(self, event):
+        # 通知ファイルは一時ファイルからの名前の変更で作られる
+        self.dispatch_batch_notification(event.dest_path)
+
+    def dispatch_pending_batch_notifications(self):
+        """
+        起動前に置かれた未処理の撮影完了通知を、撮影時刻の順にキューに入れる。
+        監視を開始してから呼ぶので、監視のイベントと重なった通知は重複しないように除く
+        """
+        for notification_path in list_batch_notifications(config.BATCH_NOTIFY_DIR):
+            # 一覧を作った後に監視のイベントから処理が終わった通知は飛ばす
+            if os.path.exists(notification_path):
+                self.dispatch_batch_notification(notification_path)
+
+    def dispatch_batch_notification(self, notification_path):
+        """
+        撮影完了通知ファイルを撮影フォルダのポートのキューに入れる
+        :param notification_path: 通知ファイルのパス
+        """
+        if not is_batch_notification(notification_path):
+            return
+        with self._notification_lock:
+            if notification_path in self._dispatched_notifications:
+                return
+            self._dispatched_notifications.add(notification_path)
+        notification = read_batch_notification(notification_path)
+        if notification is None or not self.task_dispatcher.dispatch(notification["port"], notification_path):
+            self._finish_batch_notification(notification_path)
+
+    def process_batch_notification(self, notification_path):
+        """
+        撮影完了通知ファイルの撮影フォルダを処理し、通知ファイルを削除する。
+        結果をDBWriterでまとめて書き込む場合は、コミットが終わってから削除し、書き込む前に停止しても起動時に処理し直す
+        :param notification_path: 通知ファイルのパス
+        """
+        save_future = None
+        try:
+            notification = read_batch_notification(notification_path)
+            if notification is not None:
+                directory = notification["directory"].replace(os.sep, '/')
+                print(directory)
+                save_future = self.do_tasks(directory, images=notification.get("images"),
+                                            ring_reference=notification.get("ring"))
+        finally:
+            if save_future is None:
+                self._finish_batch_notification(notification_path)
+            else:
+                save_future.add_done_callback(
+                    lambda future: self._finish_saved_batch_notification(notification_path, future))
+
+    def _finish_saved_batch_notification(self, notification_path, save_future):
+        if save_future.exception() is not None:
+            print(f"{notification_path} could not be saved. {save_future.exception()}")
+        self._finish_batch_notification(notification_path)
+
+    def _finish_batch_notification(self, notification_path):
+        remove_batch_notification(notification_path)
+        with self._notification_lock:
+            self._dispatched_notifications.discard(notification_path)
 
     def send_message_to_browser(self, message):
-        self.connect_mqtt()
-        self.mqtt_client.loop_start()
-        self.mqtt_client.publish(self.mqtt_topic, message)
-        self.mqtt_client.loop_stop()
-
-    def do_tasks(self, directory):
+        self.mqtt_publisher.publish(message)
+
+    def send_batched_message_to_browser(self, timestamp, messages):
+        """
+        同じ撮影時刻の全設定の値を１つのメッセージで送る
+        :param timestamp: 撮影時刻
+        :param messages: 設定ごとのメッセージの辞書の配列
+        """
+        self.send_message_to_browser(json.dumps({"timestamp": utils.to_time_string(timestamp), "values": messages}))
+
+    def do_tasks(self, directory, images=None, ring_reference=None):
+        """
+        撮影フォルダ１つ分のOCRを行い、結果の書き込み、ブラウザへの送信、アラートメールの送信をする
+        :param directory: 撮影フォルダのパス
+        :param images: フレームの画像ファイルのパスの配列。Noneの場合は撮影フォルダから探す
+        :param ring_reference: フレームを格納したリングバッファの参照。Noneの場合は画像ファイルから読み込む
+        :return: DBWriterに渡した書き込みのFuture。書き込みが終わっている場合はNone
+        """
+        _setting_snapshot.refresh()
         timestamp = self.extract_timestamp(directory)
         print(timestamp)
         port = self.extract_port(directory)
         setting_ids = load_setting_ids(port)
-        images = self.extract_image_pathes(directory)
-
-        for setting_id in setting_ids:
-            ocr_handler = OCRHandlerFactory().create_ocr_handler(setting_id)
-            if ocr_handler is None:
-                continue
-
-            ocr_value, image_path = ocr_handler.calculate_ocr_value(images)
-            image_name = os.path.basename(image_path)
-            print(image_name)
-            save_dir = f"{config.REGION_IMAGE_DIR}/{setting_id}"
-            os.makedirs(save_dir, exist_ok=True)
-            save_path = f"{save_dir}/{image_name}"
-            print(save_path, image_path)
-            ocr_handler.save(image_path=image_path, save_path=save_path)
+        if images is None:
+            images = self.extract_image_pathes(directory)
+        alert_messages = []
+        browser_messages = []
+        save_data_list = []
+
+        for setting_id, ocr_result in self.calculate_ocr_results(setting_ids, images, ring_reference):
+            ocr_value, image_path, save_path = ocr_result
             event_type, is_send_alert = self.calculate_event_type_and_is_send_alert(setting_id, ocr_value,
                                                                                     timestamp)
             save_data = SensorValue2(
@@ -346,50 +838,133 @@ class OCRProcessHandler(FileSystemEventHandler):
             ui_timestamp = utils.to_time_string(timestamp)
             send_message = {"setting_id": setting_id, "ocr_value": ocr_value, "timestamp": ui_timestamp,
                             "event_type": event_type, "region_image_path": "/".join(save_path.split("/")[4:])}
-            self.send_message_to_browser(json.dumps(send_message))
+            if config.MQTT_BATCH_MESSAGES:
+                browser_messages.append(send_message)
+            else:
+                self.send_message_to_browser(json.dumps(send_message))
 
-            self.save(save_data)
+            save_data_list.append(save_data)
 
             if is_send_alert:
-                alert_message = self.create_alert_message(setting_id, ocr_value, event_type)
-                self.message_pool.add(alert_message)
+                alert_messages.append(self.create_alert_message(setting_id, ocr_value, event_type))
 
-        self.send_alert()
-        self.message_pool.clear()
+        if config.MQTT_BATCH_MESSAGES:
+            self.mqtt_message_batcher.add(timestamp, port, browser_messages)
+
+        save_future = self.save(save_data_list)
+
+        with self._alert_lock:
+            for alert_message in alert_messages:
+                self.message_pool.add(alert_message)
+            self.send_alert()
+            self.message_pool.clear()
+        return save_future
+
+    def calculate_ocr_results(self, setting_ids, images, ring_reference=None):
+        """
+        設定ごとのOCRを行い、設定IDの順に結果を返す。プロセスプールがある場合は設定ごとに並列に実行する。
+        リングバッファのフレームが処理中に上書きされた場合は、画像ファイルから読み込んでやり直す
+        :param setting_ids: 同じカメラの設定IDの配列
+        :param images: フレームの画像ファイルのパスの配列
+        :param ring_reference: フレームを格納したリングバッファの参照。Noneの場合は画像ファイルから読み込む
+        :return: (設定ID, (OCR値, 選ばれた画像ファイルのパス, 表示領域の画像の保存先))の配列。無効な設定は含まない
+        """
+        ocr_handler_factory = OCRHandlerFactory()
+        setting_ids = [setting_id for setting_id in setting_ids
+                       if not ocr_handler_factory.load_ocr_setting(setting_id).is_setting_disabled]
+        # 撮影解像度が設定画面の画像と異なる場合は、設定の座標をフレームの倍率に合わせる
+        frame_size = load_frame_size(images, ring_reference)
+        source_scales = [ocr_handler_factory.load_source_scale(setting_id, frame_size) for setting_id in setting_ids]
+        # 同じカメラの全設定でフレームを共有できるように、最も小さい縮小率で読み込む
+        reduction = min([ocr_handler_factory.load_source_reduction(setting_id, source_scale)
+                         for setting_id, source_scale in zip(setting_ids, source_scales)],
+                        default=1)
+        if self.ocr_executor is None:
+            # フレームはこの撮影の設定間でだけ共有し、戻るときに解放する
+            frame_cache = create_frame_cache(images, reduction, ring_reference)
+            ocr_results = [calculate_ocr_result(setting_id, images, reduction, ring_reference, source_scale,
+                                                frame_cache)
+                           for setting_id, source_scale in zip(setting_ids, source_scales)]
+            del frame_cache
+        else:
+            # ワーカープロセスは設定ごとに読み込み、呼び出しが終わるとフレームを解放する
+            futures = [self.ocr_executor.submit(calculate_ocr_result, setting_id, images, reduction, ring_reference,
+                                                source_scale)
+                       for setting_id, source_scale in zip(setting_ids, source_scales)]
+            ocr_results = [future.result() for future in futures]
+        if ring_reference is not None and not is_ring_reference_current(ring_reference):
+            print("frame ring was overwritten during OCR. retry with image files")
+            wait_frame_archive(images)
+            return self.calculate_ocr_results(setting_ids, images)
+        return [(setting_id, ocr_result) for setting_id, ocr_result in zip(setting_ids, ocr_results)
+                if ocr_result is not None]
 
     def create_alert_message(self, setting_id, ocr_value, event_type):
-        email_message_creator = EmailMessageFactory().create(setting_id)
+        email_message_creator = _setting_snapshot.get_object(("email_message_creator", setting_id),
+                                                             lambda: EmailMessageFactory().create(setting_id))
         alert_message = email_message_creator.create_message(value=ocr_value, event=event_type)
         return alert_message
 
     def calculate_event_type_and_is_send_alert(self, setting_id, ocr_value, timestamp):
-        value_event_calculator = EventCalculatorFactory().create_event_calculator(setting_id)
+        value_event_calculator = _setting_snapshot.get_object(
+            ("event_calculator", setting_id), lambda: EventCalculatorFactory().create_event_calculator(setting_id))
         raw_event_type = value_event_calculator.calculate_status(ocr_value)
-        print(type(self.event_policies))
-        event_type, is_send_alert = self.event_policies[0][setting_id].get_event_type(event_type=raw_event_type,
-                                                                                      event_time=timestamp)
+        event_type, is_send_alert = self.get_event_policy(setting_id).get_event_type(event_type=raw_event_type,
+                                                                                     event_time=timestamp)
         is_alert_valid = self.load_is_alert_valid(setting_id)
         if not is_alert_valid:
             is_send_alert = False
         return event_type, is_send_alert
 
-    def send_alert(self):
-        email_sender = EmailSenderFactory().create_email_sender()
+    def get_event_policy(self, setting_id):
+        """
+        設定IDのイベントの確定方針を返す。起動後に追加された設定の場合は作る
+        :param setting_id: 設定ID
+        :return: EventPolicy
+        """
+        event_policies = self.event_policies[0]
+        if setting_id not in event_policies:
+            event_policies[setting_id] = EventPolicyFactory().create_event_policy(setting_id)
+        return event_policies[setting_id]
 
+    def send_alert(self):
         alert_messages = self.message_pool.merge_to_string()
         print(alert_messages)
-        if alert_messages != "":
-            email_sender.send_email(alert_messages)
-
-    def save(self, data):
+        if alert_messages == "":
+            return
+        if self.mail_dispatcher is not None:
+            # 送信は待たずにEmailDispatcherのスレッドに任せる
+            self.mail_dispatcher.put(alert_messages)
+            return
+        email_sender = _setting_snapshot.get_object("email_sender", EmailSenderFactory().create_email_sender)
+        email_sender.send_email(alert_messages)
+
+    def save(self, data_list):
+        """
+        撮影フォルダ１つ分の結果を書き込む。DBWriterがある場合は他のカメラの結果とまとめて書き込む
+        :param data_list: SensorValue2の配列
+        :return: DBWriterに渡した書き込みのFuture。書き込みが終わっている場合はNone
+        """
+        if not data_list:
+            return None
+        if self.db_writer is not None:
+            return self.db_writer.add_all(data_list)
         with ScopedSessionClass() as session:
             try:
-                session.add(data)
+                session.add_all(data_list)
                 session.commit()
             except Exception as e:
                 # エラーが発生した場合はロールバック
                 session.rollback()
                 raise e
+        return None
+
+    def close(self):
+        """
+        DBWriterの書き込み待ちをコミットしてから停止する
+        """
+        if self.db_writer is not None:
+            self.db_writer.stop()
 
     def extract_image_pathes(self, directory):
         print(glob.glob(f"{directory}/*"))
@@ -408,15 +983,15 @@ class OCRProcessHandler(FileSystemEventHandler):
         return port_name.split("_")[-1]
 
     def load_is_alert_valid(self, setting_id):
-        session = ScopedSessionClass()
-        is_alert_valid = session.query(DBThresholdSetting).filter(DBThresholdSetting.setting_id == setting_id).first()
-        return is_alert_valid
+        threshold_setting = _setting_snapshot.get_threshold_setting(setting_id)
+        return threshold_setting is not None and bool(threshold_setting.is_alert)
 
 
 def main():
     email_message_pool = EmailMessagePool()
     mqtt_client = MQTTClientFactory(on_connect=on_connect, on_disconnect=on_disconnect, user_name=None, password=None,
-                                    on_message=None).create()
+                                    on_message=None, reconnect_min_delay_sec=config.MQTT_RECONNECT_MIN_DELAY_SEC,
+                                    reconnect_max_delay_sec=config.MQTT_RECONNECT_MAX_DELAY_SEC).create()
     event_policies = EventPolicyFactory().create_event_policies()
     print(type(event_policies))
     ocr_process_handler = OCRProcessHandler(
@@ -426,9 +1001,23 @@ def main():
         mqtt_client=mqtt_client,
         mqtt_broker_port=config.MQTT_BROKER_PORT,
         mqtt_keep_alive=config.MQTT_KEEP_ALIVE_SEC,
-        mqtt_topic=config.MQTT_BROWSER_TOPIC)
-    w = FileEventHandler(config.IMAGE_STORAGE_DIR, ocr_process_handler)
-    w.run()
+        mqtt_topic=config.MQTT_BROWSER_TOPIC,
+        ocr_executor=create_ocr_executor(),
+        mqtt_outbox=create_mqtt_outbox(),
+        mail_dispatcher=create_mail_dispatcher(),
+        db_writer=create_db_writer())
+    ocr_process_handler.connect_mqtt()
+    os.makedirs(config.BATCH_NOTIFY_DIR, exist_ok=True)
+    w = FileEventHandler(config.BATCH_NOTIFY_DIR, ocr_process_handler)
+    # 監視を開始してから未処理の通知を読み直し、その間に置かれた通知も取りこぼさない
+    w.start()
+    ocr_process_handler.dispatch_pending_batch_notifications()
+    # SIGTERMで停止された場合も監視の終了処理と書き込み待ちのコミットを行う
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        w.run()
+    finally:
+        ocr_process_handler.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,13 @@
 import sys
 sys.path.append('/home/pi/.local/lib/python3.9/site-packages')
 sys.path.append('/home/pi/ocr_project')
+import concurrent.futures
+import queue
 import threading
 import time
 from rixiot_libs.camera import create_camera
+from rixiot_libs.batch import mark_archive_complete, notify_batch_complete
+from rixiot_libs.frame_ring import FrameRing, get_frame_ring_name
 import os
 import cv2
 import config
@@ -11,18 +15,73 @@ from common_libs.db_models import DBCameraSetting
 from common_libs import utils
 from common_libs.db_models import SessionClass
 from rixiot_libs.mqtt_factory import MQTTClientFactory, on_connect, on_disconnect
-from image_processing_task import EmailMessagePool,EventPolicyFactory
+from image_processing_task import EmailMessagePool,EventPolicyFactory, OCRHandlerFactory, refresh_setting_snapshot
 
 def get_camera_list():
     session = SessionClass()
     port_list = session.query(DBCameraSetting.usb_port).all()
     print(port_list)
-    camera_list = [create_camera(config.CameraType.USB, port=port[0], fps=config.FPS, buffer_size=1) for port in
-                   port_list]
+    ocr_handler_factory = OCRHandlerFactory()
+    camera_list = [create_camera(config.CameraType.USB, is_persistent=config.CAMERA_PERSISTENT_SESSION,
+                                 port=port[0], buffer_size=1,
+                                 fps=config.CAMERA_PERSISTENT_FPS if config.CAMERA_PERSISTENT_SESSION else config.FPS,
+                                 is_mjpeg_passthrough=config.CAMERA_MJPEG_PASSTHROUGH,
+                                 resolution=ocr_handler_factory.load_capture_resolution(port[0],
+                                                                                        config.CAPTURE_RESOLUTIONS))
+                   for port in port_list]
     print(camera_list)
+    if config.CAMERA_PERSISTENT_SESSION:
+        # 最初の撮影までにカメラを開いて露出を安定させておく
+        for camera in camera_list:
+            camera.start()
     return camera_list
 
 
+def create_frame_rings(camera_list):
+    """
+    カメラのポートごとのリングバッファを作成する
+    :param camera_list: カメラの配列
+    :return: ポート番号をキーとしたFrameRingの辞書。リングバッファを使わない場合は空
+    """
+    if not config.FRAME_RING_ENABLED or config.CAMERA_MJPEG_PASSTHROUGH:
+        return {}
+    return {camera.port: FrameRing.create(get_frame_ring_name(camera.port),
+                                          slot_count=config.IMAGE_COUNT * config.FRAME_RING_BATCH_COUNT,
+                                          max_frame_shape=config.FRAME_RING_MAX_FRAME_SHAPE)
+            for camera in camera_list}
+
+
+class ImageArchiveWriter(threading.Thread):
+    def __init__(self):
+        """
+        撮影画像のJPEGファイルへの保存を撮影とは別のスレッドで行う。
+        撮影フォルダの全フレームを保存したら完了ファイルを置き、画像ファイルを待っている画像処理に知らせる
+        """
+        super().__init__(daemon=True)
+        self._queue = queue.Queue()
+
+    def put(self, image_directory, images):
+        """
+        撮影フォルダ１つ分のフレームを保存待ちにする
+        :param image_directory: 撮影フォルダのパス
+        :param images: 画像ファイルのパスをキーとしたフレームの辞書
+        """
+        self._queue.put((image_directory, images))
+
+    def run(self):
+        while True:
+            image_directory, images = self._queue.get()
+            for image_path, image in images.items():
+                try:
+                    cv2.imwrite(image_path, image)
+                except Exception as e:
+                    print(e)
+            try:
+                mark_archive_complete(image_directory)
+            except OSError as e:
+                print(e)
+
+
 class CameraImageStorage(threading.Thread):
     def __init__(self, camera_list, mqtt_broker_ip, mqtt_client, mqtt_broker_port, mqtt_keep_alive, mqtt_topic,event_policies,email_message_pool):
         super().__init__()
@@ -33,32 +92,105 @@ class CameraImageStorage(threading.Thread):
         self.mqtt_broker_port = mqtt_broker_port
         self.mqtt_keep_alive = mqtt_keep_alive
         self.mqtt_topic = mqtt_topic
+        self._frame_rings = create_frame_rings(camera_list)
+        self._archive_writer = None
+        if self._frame_rings:
+            self._archive_writer = ImageArchiveWriter()
+            self._archive_writer.start()
 
     def run(self):
-        while not self._stop_event.is_set():
-            timestamp = utils.get_timestamp()
+        # 全カメラを並列に撮影し、撮影時間に関係なくSTORE_INTERVAL_SEC毎に撮影を始める
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self._camera_list), 1),
+                                                   thread_name_prefix="capture") as executor:
+            next_cycle_time = time.monotonic()
+            while not self._stop_event.is_set():
+                self.update_capture_resolutions()
+                timestamp = utils.get_timestamp()
+                list(executor.map(lambda camera: self.store_camera_images(camera, timestamp), self._camera_list))
+                next_cycle_time = max(next_cycle_time + config.STORE_INTERVAL_SEC, time.monotonic())
+                self._stop_event.wait(next_cycle_time - time.monotonic())
+        if config.CAMERA_PERSISTENT_SESSION:
             for camera in self._camera_list:
-                try:
-                    print(f"camera.port:{camera.port}")
-                    image_directory = f"{config.IMAGE_STORAGE_DIR}/PORT_{camera.port}/{timestamp}"
-                    
-                    image_list = []
-                    for i in range(config.IMAGE_COUNT):
-                        print(str(i))
-                        image_list.append(camera.get_image())
-                        time.sleep(1)
-                    os.makedirs(image_directory, exist_ok=True)
-                    for i, image in enumerate(image_list):
-                        if image is not None:
-                            cv2.imwrite(f"{image_directory}/{timestamp}_{i}.jpg", image)
-
-                except Exception as e:
-
-                    print(e)
-
-                    time.sleep(5)
-
-            time.sleep(config.STORE_INTERVAL_SEC)
+                camera.stop()
+
+    def update_capture_resolutions(self):
+        """
+        画面から設定が変更されて設定の版が上がった場合は、カメラごとの撮影解像度を求め直す
+        """
+        if not config.CAPTURE_RESOLUTIONS or not refresh_setting_snapshot():
+            return
+        ocr_handler_factory = OCRHandlerFactory()
+        for camera in self._camera_list:
+            resolution = ocr_handler_factory.load_capture_resolution(camera.port, config.CAPTURE_RESOLUTIONS)
+            if resolution != camera.resolution:
+                print(f"camera port:{camera.port} capture resolution {camera.resolution} -> {resolution}")
+                camera.set_resolution(resolution)
+
+    def store_camera_images(self, camera, timestamp):
+        """
+        カメラでIMAGE_COUNT枚のフレームを撮影して保存し、画像処理に撮影完了を知らせる
+        :param camera: カメラ
+        :param timestamp: 撮影時刻の文字列
+        """
+        try:
+            print(f"camera.port:{camera.port}")
+            image_directory = f"{config.IMAGE_STORAGE_DIR}/PORT_{camera.port}/{timestamp}"
+            if config.CAMERA_MJPEG_PASSTHROUGH:
+                self.store_encoded_images(camera, image_directory, timestamp)
+                return
+
+            image_list = camera.get_images(config.IMAGE_COUNT, config.CAPTURE_FRAME_INTERVAL_SEC)
+            os.makedirs(image_directory, exist_ok=True)
+            images = {f"{image_directory}/{timestamp}_{i}.jpg": image for i, image in enumerate(image_list)
+                      if image is not None}
+            ring_reference = self.write_frame_ring(camera.port, images)
+            if ring_reference is None:
+                for image_path, image in images.items():
+                    cv2.imwrite(image_path, image)
+                # 全フレームの保存が終わってから画像処理に知らせる
+                notify_batch_complete(config.BATCH_NOTIFY_DIR, image_directory, camera.port, timestamp)
+            else:
+                # リングバッファから画像処理を始め、JPEGファイルは後から保存する
+                notify_batch_complete(config.BATCH_NOTIFY_DIR, image_directory, camera.port, timestamp,
+                                      images=list(images), ring_reference=ring_reference)
+                self._archive_writer.put(image_directory, images)
+
+        except Exception as e:
+
+            print(e)
+
+    def store_encoded_images(self, camera, image_directory, timestamp):
+        """
+        カメラから受け取ったJPEGのバイト列をそのまま画像ファイルに書き込み、画像処理に撮影完了を知らせる
+        :param camera: カメラ
+        :param image_directory: 撮影フォルダのパス
+        :param timestamp: 撮影時刻の文字列
+        """
+        encoded_images = camera.get_encoded_images(config.IMAGE_COUNT, config.CAPTURE_FRAME_INTERVAL_SEC)
+        os.makedirs(image_directory, exist_ok=True)
+        for i, encoded_image in enumerate(encoded_images):
+            with open(f"{image_directory}/{timestamp}_{i}.jpg", "wb") as f:
+                f.write(encoded_image)
+        notify_batch_complete(config.BATCH_NOTIFY_DIR, image_directory, camera.port, timestamp)
+
+    def write_frame_ring(self, port, images):
+        """
+        撮影分のフレームをポートのリングバッファに書き込む
+        :param port: カメラのポート番号
+        :param images: 画像ファイルのパスをキーとしたフレームの辞書
+        :return: リングバッファの参照。リングバッファを使わない場合や、スロットに収まらないフレームがある場合はNone
+        """
+        frame_ring = self._frame_rings.get(port)
+        if frame_ring is None or not images:
+            return None
+        frames = []
+        for image_path, image in images.items():
+            slot = frame_ring.write(image)
+            if slot is None:
+                print(f"frame of {image_path} does not fit in the frame ring")
+                return None
+            frames.append([image_path, slot[0], slot[1]])
+        return {"name": frame_ring.name, "ring_id": frame_ring.ring_id, "frames": frames}
 
     def send_message_to_browser(self, message):
         self.connect_mqtt()
@@ -0,0 +1,106 @@
+import glob
+import json
+import os
+import time
+
+# 撮影完了通知ファイルの拡張子
+BATCH_NOTIFICATION_SUFFIX = ".batch"
+# リングバッファで渡した撮影フォルダに、JPEGファイルの保存が終わった時に置くファイルの名前
+ARCHIVE_COMPLETE_FILE_NAME = ".archived"
+
+
+def notify_batch_complete(notify_dir, image_directory, port, timestamp, images=None, ring_reference=None):
+    """
+    撮影フォルダへの全フレームの保存が終わったことを、通知フォルダに通知ファイルを置いて知らせる。
+    一時ファイルに書き込んでから名前を変えるので、通知ファイルは書きかけの状態で見えない
+
+    :param notify_dir: 通知フォルダのパス
+    :param image_directory: 撮影フォルダのパス
+    :param port: カメラのポート番号
+    :param timestamp: 撮影時刻の文字列
+    :param images: フレームの画像ファイルのパスの配列。Noneの場合は画像処理側で撮影フォルダから探す
+    :param ring_reference: フレームを格納したリングバッファの参照。Noneの場合は画像ファイルから読み込む
+    :return: 通知ファイルのパス
+    """
+    os.makedirs(notify_dir, exist_ok=True)
+    notification_path = os.path.join(notify_dir, f"{timestamp}_PORT_{port}{BATCH_NOTIFICATION_SUFFIX}")
+    temporary_path = f"{notification_path}.tmp"
+    notification = {"directory": image_directory, "port": str(port), "timestamp": timestamp}
+    if images is not None:
+        notification["images"] = images
+    if ring_reference is not None:
+        notification["ring"] = ring_reference
+    with open(temporary_path, "w") as f:
+        json.dump(notification, f)
+    os.replace(temporary_path, notification_path)
+    return notification_path
+
+
+def is_batch_notification(path):
+    """
+    撮影完了通知ファイルかどうかを返す
+    :param path: ファイルのパス
+    :return: 通知ファイルの場合はTrue
+    """
+    return path.endswith(BATCH_NOTIFICATION_SUFFIX)
+
+
+def read_batch_notification(notification_path):
+    """
+    通知ファイルから撮影フォルダの情報を読み込む
+    :param notification_path: 通知ファイルのパス
+    :return: {"directory","port","timestamp"(,"images","ring")}。読み込めない場合はNone
+    """
+    try:
+        with open(notification_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"{notification_path} {e}")
+        return None
+
+
+def list_batch_notifications(notify_dir):
+    """
+    未処理の通知ファイルを撮影時刻の順に返す
+    :param notify_dir: 通知フォルダのパス
+    :return: 通知ファイルのパスの配列
+    """
+    return sorted(glob.glob(os.path.join(notify_dir, f"*{BATCH_NOTIFICATION_SUFFIX}")))
+
+
+def mark_archive_complete(image_directory):
+    """
+    撮影フォルダの全フレームのJPEGファイルの保存が終わったことを、撮影フォルダに完了ファイルを置いて知らせる
+    :param image_directory: 撮影フォルダのパス
+    """
+    with open(os.path.join(image_directory, ARCHIVE_COMPLETE_FILE_NAME), "w"):
+        pass
+
+
+def wait_archive_complete(image_directory, timeout_sec, poll_interval_sec=0.05):
+    """
+    撮影フォルダのJPEGファイルの保存が終わるまで待つ
+    :param image_directory: 撮影フォルダのパス
+    :param timeout_sec: 待つ最大時間(秒)
+    :param poll_interval_sec: 完了ファイルを確認する間隔(秒)
+    :return: 保存が終わった場合はTrue
+    """
+    marker_path = os.path.join(image_directory, ARCHIVE_COMPLETE_FILE_NAME)
+    deadline = time.monotonic() + timeout_sec
+    while not os.path.exists(marker_path):
+        if time.monotonic() >= deadline:
+            print(f"{image_directory} is not archived in {timeout_sec} sec")
+            return False
+        time.sleep(poll_interval_sec)
+    return True
+
+
+def remove_batch_notification(notification_path):
+    """
+    処理済みの通知ファイルを削除する
+    :param notification_path: 通知ファイルのパス
+    """
+    try:
+        os.remove(notification_path)
+    except FileNotFoundError:
+        pass
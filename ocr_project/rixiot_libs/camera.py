@@ -1,47 +1,225 @@
-import subprocess
+import functools
+import os
+import re
+import struct
+import threading
+import time
 import config
 import cv2
+import numpy as np
 import abc
 
+# USBポートごとのVideoデバイスへのシンボリックリンクがあるフォルダ
+V4L_BY_PATH_DIR = "/dev/v4l/by-path"
+# by-pathの名前のUSBポート値(例: ...-usb-0:1.1.4:1.0-video-index0 の 1.4)
+_USB_PORT_PATTERN = re.compile(r"usb-0:1\.([0-9.]+):")
+_VIDEO_DEVICE_PATTERN = re.compile(r"video(\d+)$")
 
-def create_camera(camera_type, **kwargs):
+# JPEGのマーカー
+_JPEG_SOI = b"\xff\xd8"
+_JPEG_DHT = 0xC4
+_JPEG_SOS = 0xDA
+
+
+def create_camera(camera_type, is_persistent=False, **kwargs):
+    """
+    カメラを作成する
+    :param camera_type: config.CameraType
+    :param is_persistent: Trueの場合、カメラを開いたままにして撮影スレッドで最新のフレームを保持する
+    :param kwargs: カメラの引数
+    :return: Camera
+    """
     if camera_type == config.CameraType.USB:
+        if is_persistent:
+            return PersistentUsbCamera(**kwargs)
         return UsbCamera(**kwargs)
 
 
 
+def _is_raw_buffer(frame):
+    """
+    カメラからBGRに変換せずに受け取ったフレームかどうかを返す。変換しないフレームはどの画素形式でも1次元のバイト列になる
+    :param frame: フレーム
+    :return: 変換前のバイト列の場合はTrue
+    """
+    return frame.ndim == 1 or (frame.ndim == 2 and frame.shape[0] == 1)
+
+
+def is_encoded_frame(frame):
+    """
+    カメラから変換せずに受け取ったJPEGのフレームかどうかを返す
+    :param frame: フレーム
+    :return: JPEGのSOIマーカーで始まるバイト列の場合はTrue
+    """
+    if not _is_raw_buffer(frame) or frame.dtype != np.uint8:
+        return False
+    return frame.reshape(-1)[:len(_JPEG_SOI)].tobytes() == _JPEG_SOI
+
+
+@functools.lru_cache(maxsize=None)
+def _get_default_huffman_tables():
+    """
+    JPEG規格(Annex K.3)の標準ハフマンテーブルのDHTセグメントを返す。
+    標準テーブルで符号化したJPEGから取り出す
+    :return: DHTセグメントのバイト列
+    """
+    ret, buffer = cv2.imencode(".jpg", np.zeros((8, 8, 3), np.uint8), [cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+    segments = []
+    data = buffer.tobytes()
+    position = len(_JPEG_SOI)
+    while position + 4 <= len(data) and data[position] == 0xFF and data[position + 1] != _JPEG_SOS:
+        length = struct.unpack(">H", data[position + 2:position + 4])[0]
+        if data[position + 1] == _JPEG_DHT:
+            segments.append(data[position:position + 2 + length])
+        position += 2 + length
+    return b"".join(segments)
+
+
+def add_default_huffman_tables(jpeg_bytes):
+    """
+    ハフマンテーブル(DHT)を省略したMJPEGのフレームに標準ハフマンテーブルを挿入し、単体で読めるJPEGにする
+    :param jpeg_bytes: JPEGのバイト列
+    :return: JPEGのバイト列。DHTがある場合や、JPEGとして解釈できない場合はそのまま返す
+    """
+    if not jpeg_bytes.startswith(_JPEG_SOI):
+        return jpeg_bytes
+    position = len(_JPEG_SOI)
+    while position + 4 <= len(jpeg_bytes) and jpeg_bytes[position] == 0xFF:
+        marker = jpeg_bytes[position + 1]
+        if marker == _JPEG_DHT:
+            return jpeg_bytes
+        if marker == _JPEG_SOS:
+            return jpeg_bytes[:position] + _get_default_huffman_tables() + jpeg_bytes[position:]
+        length = struct.unpack(">H", jpeg_bytes[position + 2:position + 4])[0]
+        position += 2 + length
+    return jpeg_bytes
+
+
+def decode_frame(frame):
+    """
+    フレームがJPEGの場合はBGRの画像に変換する
+    :param frame: フレーム
+    :return: BGRの画像。変換できない場合はNone
+    """
+    if frame is None:
+        return None
+    if not is_encoded_frame(frame):
+        # JPEGではない変換前のバイト列は画像として扱えない
+        return None if _is_raw_buffer(frame) else frame
+    return cv2.imdecode(frame.reshape(-1), cv2.IMREAD_COLOR)
+
+
+def encode_frame(frame):
+    """
+    フレームをJPEGファイルに書き込めるバイト列にする。JPEGのフレームは再圧縮しない
+    :param frame: フレーム
+    :return: JPEGのバイト列。変換できない場合はNone
+    """
+    if frame is None:
+        return None
+    if is_encoded_frame(frame):
+        return add_default_huffman_tables(frame.tobytes())
+    if _is_raw_buffer(frame):
+        # JPEGではない変換前のバイト列はJPEGファイルに書き込めない
+        return None
+    ret, buffer = cv2.imencode(".jpg", frame)
+    return buffer.tobytes() if ret else None
+
+
 class Camera(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def get_image(self):
         pass
 
+    def get_images(self, count, interval_sec=0):
+        """
+        フレームを続けて撮影する
+        :param count: フレーム数
+        :param interval_sec: フレームの間隔(秒)
+        :return: フレームの配列。撮影できなかったフレームは含まない
+        """
+        images = []
+        for i in range(count):
+            if i > 0 and interval_sec > 0:
+                time.sleep(interval_sec)
+            image = self.get_image()
+            if image is not None:
+                images.append(image)
+        return images
+
+    def get_encoded_images(self, count, interval_sec=0):
+        """
+        フレームを続けて撮影し、JPEGファイルに書き込めるバイト列で返す
+        :param count: フレーム数
+        :param interval_sec: フレームの間隔(秒)
+        :return: JPEGのバイト列の配列。撮影できなかったフレームは含まない
+        """
+        images = [encode_frame(image) for image in self.get_images(count, interval_sec)]
+        return [image for image in images if image is not None]
+
 
 class UsbCamera(Camera):
 
-    def __init__(self, port, fps, buffer_size):
+    def __init__(self, port, fps, buffer_size, is_mjpeg_passthrough=False, resolution=None):
+        """
+        USBカメラ
+        :param port: カメラのポート番号
+        :param fps: フレームレート
+        :param buffer_size: ドライバのバッファ数
+        :param is_mjpeg_passthrough: Trueの場合、MJPEGで受け取ったフレームを変換せずにJPEGのまま保持する
+        :param resolution: 撮影解像度(幅, 高さ)。Noneの場合はカメラの既定の解像度
+        """
         self.port = port
         self.fps = fps
         self.buffer_size = buffer_size
+        self.is_mjpeg_passthrough = is_mjpeg_passthrough
+        self.resolution = resolution
+        # Trueの場合、USBの帯域を減らすためにMJPEGで転送させる。フレームは取り出す時にBGRに変換される
+        self.is_mjpeg_transfer = False
 
     def _get_cap(self):
         video_id = self._get_video_id()
         #print(video_id)
         if video_id is not None:
             cap = cv2.VideoCapture(video_id)
+            if not cap.isOpened():
+                # デバイスが付け替えられた可能性があるので、次はVideoデバイスを調べ直す
+                get_usb_video_device_registry().invalidate()
+                cap.release()
+                return None
             # 画像をキャプチャする
+            if self.is_mjpeg_passthrough or self.is_mjpeg_transfer:
+                cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+            if self.resolution is not None:
+                cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+                resolution = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                if resolution != tuple(self.resolution):
+                    # 画像処理はフレームの大きさから倍率を求めるので、異なる解像度でも座標はずれない
+                    print(f"camera port:{self.port} resolution {self.resolution} is not supported. use {resolution}")
             cap.set(cv2.CAP_PROP_FPS, self.fps)
             cap.set(cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)
+            is_mjpeg = int(cap.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*"MJPG")
+            if self.is_mjpeg_passthrough:
+                # 変換を止めるとドライバのバッファがそのまま返るので、実際にMJPEGになった場合だけBGRに変換せずに受け取る
+                if is_mjpeg:
+                    cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+                else:
+                    print(f"camera port:{self.port} does not deliver MJPG. frames are converted to BGR")
+            elif self.is_mjpeg_transfer and not is_mjpeg:
+                print(f"camera port:{self.port} does not deliver MJPG. USB bandwidth may be insufficient")
             return cap
         return None
 
     def _get_video_id(self):
-        usb_hub = UsbHub(mapping=config.USB_PORT_MAPPING)
-        #print(usb_hub.mapping)
-        port_id = usb_hub.get_port_id(self.port)
-        #print(f"port_id:{port_id}")
-        usb_video_device = UsbVideoDevice()
-        #print("ok")
-        return usb_video_device.get_video_id(port_id)
+        return get_usb_video_device_registry().get_video_id(self.port)
+
+    def set_resolution(self, resolution):
+        """
+        撮影解像度を変える。次にカメラを開いた時から使う
+        :param resolution: 撮影解像度(幅, 高さ)。Noneの場合はカメラの既定の解像度
+        """
+        self.resolution = resolution
 
     @staticmethod
     def _get_image(cap):
@@ -51,6 +229,34 @@ class UsbCamera(Camera):
         return None
 
     def get_image(self):
+        """
+        １枚撮影する
+        :return: BGRの画像。撮影できない場合はNone
+        """
+        return decode_frame(self._read_frame())
+
+    def get_images(self, count, interval_sec=0):
+        """
+        フレームを続けて撮影する
+        :param count: フレーム数
+        :param interval_sec: フレームの間隔(秒)。0の場合はカメラのフレームレートのまま撮影する
+        :return: BGRの画像の配列。撮影できなかったフレームは含まない
+        """
+        images = [decode_frame(frame) for frame in self._read_frames(count, interval_sec)]
+        return [image for image in images if image is not None]
+
+    def get_encoded_images(self, count, interval_sec=0):
+        """
+        フレームを続けて撮影し、JPEGファイルに書き込めるバイト列で返す。
+        MJPEGのまま受け取ったフレームは復号も再圧縮もしない
+        :param count: フレーム数
+        :param interval_sec: フレームの間隔(秒)。0の場合はカメラのフレームレートのまま撮影する
+        :return: JPEGのバイト列の配列。撮影できなかったフレームは含まない
+        """
+        images = [encode_frame(frame) for frame in self._read_frames(count, interval_sec)]
+        return [image for image in images if image is not None]
+
+    def _read_frame(self):
         cap = self._get_cap()
         #print(cap)
         if cap is None:
@@ -62,6 +268,192 @@ class UsbCamera(Camera):
         cap.release()
         return image
 
+    def _read_frames(self, count, interval_sec=0):
+        """
+        カメラを１回だけ開いて、バッファを読み捨ててからフレームを続けて撮影する
+        :param count: フレーム数
+        :param interval_sec: フレームの間隔(秒)。0の場合はカメラのフレームレートのまま撮影する
+        :return: フレームの配列。撮影できなかったフレームは含まない
+        """
+        cap = self._get_cap()
+        if cap is None:
+            return []
+        images = []
+        try:
+            for i in range(self.fps):
+                self._get_image(cap)
+            next_time = time.monotonic()
+            for i in range(count):
+                wait_sec = next_time - time.monotonic()
+                if wait_sec > 0:
+                    # バッファのフレームが古くならないように、待つ間も読み捨てる
+                    while time.monotonic() < next_time:
+                        self._get_image(cap)
+                image = self._get_image(cap)
+                if image is not None:
+                    images.append(image)
+                next_time += interval_sec
+        finally:
+            cap.release()
+        return images
+
+
+class PersistentUsbCamera(UsbCamera):
+
+    def __init__(self, port, fps, buffer_size, is_mjpeg_passthrough=False, resolution=None,
+                 reconnect_interval_sec=None, first_frame_timeout_sec=None):
+        """
+        カメラを開いたままにして、撮影スレッドがgrab()し続けたフレームのうち最新のものを返すUSBカメラ。
+        撮影のたびにカメラを開き直してバッファを読み捨てる必要がなく、読み込みに失敗した時だけ開き直す。
+        フレームの変換は読み出したフレームだけに行うので、撮影していない間のCPU負荷は小さい。
+        USBの帯域を減らすためにMJPEGを要求し、fpsは低い値(config.CAMERA_PERSISTENT_FPS)で使う
+
+        :param port: カメラのポート番号
+        :param fps: フレームレート
+        :param buffer_size: ドライバのバッファ数
+        :param is_mjpeg_passthrough: Trueの場合、MJPEGで受け取ったフレームを変換せずにJPEGのまま保持する
+        :param resolution: 撮影解像度(幅, 高さ)。Noneの場合はカメラの既定の解像度
+        :param reconnect_interval_sec: 読み込みに失敗した時に開き直すまでの待ち時間(秒)
+        :param first_frame_timeout_sec: 最初のフレームを待つ時間(秒)
+        """
+        super().__init__(port, fps, buffer_size, is_mjpeg_passthrough, resolution)
+        # 全カメラが開いたままUSB2の帯域を予約し続けるので、非圧縮ではなくMJPEGで転送させる
+        self.is_mjpeg_transfer = True
+        self._reconnect_interval_sec = config.CAMERA_RECONNECT_INTERVAL_SEC \
+            if reconnect_interval_sec is None else reconnect_interval_sec
+        self._first_frame_timeout_sec = config.CAMERA_FIRST_FRAME_TIMEOUT_SEC \
+            if first_frame_timeout_sec is None else first_frame_timeout_sec
+        # 撮影スレッドはgrab()でバッファを進めるだけで、フレームの取り出しと変換は読み出しを待つスレッドがある時だけ行う
+        self._frame = None
+        # 撮影スレッドがgrab()したフレームの通し番号。同じフレームを２回返さないために使う
+        self._frame_sequence = 0
+        # フレームを待っている読み出しの数
+        self._frame_request_count = 0
+        self._frame_condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        撮影スレッドを開始する。開始済みの場合は何もしない
+        """
+        with self._frame_condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._grab_frames, name=f"camera-port-{self.port}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        撮影スレッドを止めてカメラを閉じる
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._set_frame(None)
+
+    def set_resolution(self, resolution):
+        """
+        撮影解像度を変える。撮影スレッドが動いている場合はカメラを開き直す
+        :param resolution: 撮影解像度(幅, 高さ)。Noneの場合はカメラの既定の解像度
+        """
+        if resolution == self.resolution:
+            return
+        is_running = self._thread is not None
+        if is_running:
+            self.stop()
+        self.resolution = resolution
+        if is_running:
+            self.start()
+
+    def _set_frame(self, frame):
+        with self._frame_condition:
+            self._frame = frame
+            self._frame_sequence += 1
+            self._frame_condition.notify_all()
+
+    def _grab_frames(self):
+        cap = None
+        try:
+            while not self._stop_event.is_set():
+                if cap is None:
+                    cap = self._get_cap()
+                    if cap is None:
+                        print(f"camera port:{self.port} could not be opened.")
+                        self._stop_event.wait(self._reconnect_interval_sec)
+                        continue
+                if not cap.grab():
+                    print(f"camera port:{self.port} read failed. reconnecting.")
+                    cap.release()
+                    cap = None
+                    self._set_frame(None)
+                    self._stop_event.wait(self._reconnect_interval_sec)
+                    continue
+                with self._frame_condition:
+                    is_requested = self._frame_request_count > 0
+                frame = None
+                if is_requested:
+                    # retrieve()は毎回新しい配列を返すので、渡したフレームが書き換わることはない
+                    ret, frame = cap.retrieve()
+                    if not ret:
+                        frame = None
+                self._set_frame(frame)
+        finally:
+            if cap is not None:
+                cap.release()
+
+    def _wait_frame(self, last_sequence):
+        """
+        撮影スレッドにフレームの取り出しを頼み、last_sequenceより新しいフレームを待つ
+        :param last_sequence: 前回受け取ったフレームの通し番号。Noneの場合は最初に取り出したフレームを返す
+        :return: (フレームの通し番号, フレーム)。待っても取り出せない場合は(None, None)
+        """
+        with self._frame_condition:
+            self._frame_request_count += 1
+            try:
+                is_ready = self._frame_condition.wait_for(
+                    lambda: self._frame is not None and self._frame_sequence != last_sequence,
+                    self._first_frame_timeout_sec)
+                if not is_ready:
+                    return None, None
+                return self._frame_sequence, self._frame
+            finally:
+                self._frame_request_count -= 1
+
+    def _read_frame(self):
+        """
+        最新のフレームを返す。撮影スレッドが止まっている場合は開始して、最初のフレームを待つ
+        :return: フレーム。カメラから読み込めていない場合はNone
+        """
+        self.start()
+        return self._wait_frame(None)[1]
+
+    def _read_frames(self, count, interval_sec=0):
+        """
+        撮影スレッドがgrab()したフレームを、同じフレームを重複させずに続けて取り出す
+        :param count: フレーム数
+        :param interval_sec: フレームの間隔(秒)。0の場合はカメラのフレームレートのまま取得する
+        :return: フレームの配列。撮影できなかったフレームは含まない
+        """
+        self.start()
+        images = []
+        last_sequence = None
+        next_time = time.monotonic()
+        for i in range(count):
+            wait_sec = next_time - time.monotonic()
+            if wait_sec > 0:
+                self._stop_event.wait(wait_sec)
+            sequence, frame = self._wait_frame(last_sequence)
+            if frame is None:
+                print(f"camera port:{self.port} has no new frame.")
+                break
+            images.append(frame)
+            last_sequence = sequence
+            next_time += interval_sec
+        return images
+
 
 class UsbHub:
     def __init__(self, mapping):
@@ -72,58 +464,100 @@ class UsbHub:
 
 
 class UsbVideoDevice:
-    def __init__(self):
+    def __init__(self, by_path_dir=None):
+        """
+        /dev/v4l/by-pathのシンボリックリンクから、USBポートごとのVideoデバイスを調べる
+        :param by_path_dir: by-pathフォルダのパス
+        """
         self.__device_list = []
-        #print("usb?")
-        try:
-            cmd = 'ls -la /dev/v4l/by-id'
-            res = subprocess.check_output(cmd.split())
-            by_id = res.decode()
-        except Exception as e:
-            print(e)
-        #print("done")
+        by_path_dir = V4L_BY_PATH_DIR if by_path_dir is None else by_path_dir
         try:
-            cmd = 'ls -la /dev/v4l/by-path'
-            res = subprocess.check_output(cmd.split())
-            by_path = res.decode()
-        except Exception as e:
+            # 名前順にして、同じポートのメタデータ用デバイス(video-index1)よりvideo-index0を先にする
+            entries = sorted(os.scandir(by_path_dir), key=lambda entry: entry.name)
+        except OSError as e:
             print(e)
-        #print("done")
-      
-          
-                
+            return
         # ポート番号取得
-        for line in by_path.split('\n'):
-            
-            if 'usb-0' in line:
-                #print(line)
-                tmp = self.__split(line, '0-usb-0:1.')
-                tmp = self.__split(tmp[1], ':')
-                port = tmp[0]
-                #print(port)
-                tmp = self.__split(tmp[1], '../../video')
-                device_id = int(tmp[1])
-                #print(f"device_id:{device_id}")
-                self.__device_list.append((device_id, port))
-        
-        
-    @staticmethod
-    def __split(string, val):
-        tmp = string.split(val)
-        if '' in tmp:
-            tmp.remove('')
-        return tmp
+        for entry in entries:
+            port_match = _USB_PORT_PATTERN.search(entry.name)
+            if port_match is None:
+                continue
+            try:
+                video_match = _VIDEO_DEVICE_PATTERN.search(os.readlink(entry.path))
+            except OSError as e:
+                print(e)
+                continue
+            if video_match is not None:
+                self.__device_list.append((int(video_match.group(1)), port_match.group(1)))
 
     # 認識しているVideoデバイスの一覧を表示する
     def display_video_devices(self):
-        for (device_id, port, name) in self.__device_list:
-            print("/dev/video{} port:{} {}".format(device_id, port, name))
+        for (device_id, port) in self.__device_list:
+            print("/dev/video{} port:{}".format(device_id, port))
 
     # ポート番号（1..）を指定してVideoIDを取得する
     def get_video_id(self, port):
-        print(self.__device_list)
         for (device_id, p) in self.__device_list:
             if p == port:
-                print(device_id,port)
                 return device_id
         return None
+
+
+class UsbVideoDeviceRegistry:
+    def __init__(self, mapping, by_path_dir=None):
+        """
+        USBポートごとのVideoデバイスの一覧を保持し、by-pathフォルダの更新時刻が変わった時か、
+        デバイスを開けなかった時だけ調べ直す
+
+        :param mapping: カメラのポート番号とUSBポート値のマッピング
+        :param by_path_dir: by-pathフォルダのパス
+        """
+        self._usb_hub = UsbHub(mapping=mapping)
+        self._by_path_dir = V4L_BY_PATH_DIR if by_path_dir is None else by_path_dir
+        self._usb_video_device = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self._by_path_dir).st_mtime_ns
+        except OSError:
+            return None
+
+    def get_video_id(self, port):
+        """
+        カメラのポート番号のVideoIDを返す
+        :param port: カメラのポート番号
+        :return: VideoID。デバイスが無い場合はNone
+        """
+        port_id = self._usb_hub.get_port_id(port)
+        with self._lock:
+            mtime = self._get_mtime()
+            if self._usb_video_device is None or mtime != self._mtime:
+                self._usb_video_device = UsbVideoDevice(self._by_path_dir)
+                self._mtime = mtime
+                self._usb_video_device.display_video_devices()
+            return self._usb_video_device.get_video_id(port_id)
+
+    def invalidate(self):
+        """
+        次の問い合わせでVideoデバイスを調べ直す
+        """
+        with self._lock:
+            self._usb_video_device = None
+
+
+_usb_video_device_registry = None
+_usb_video_device_registry_lock = threading.Lock()
+
+
+def get_usb_video_device_registry():
+    """
+    プロセスで共有するVideoデバイスの一覧を返す
+    :return: UsbVideoDeviceRegistry
+    """
+    global _usb_video_device_registry
+    with _usb_video_device_registry_lock:
+        if _usb_video_device_registry is None:
+            _usb_video_device_registry = UsbVideoDeviceRegistry(mapping=config.USB_PORT_MAPPING)
+        return _usb_video_device_registry
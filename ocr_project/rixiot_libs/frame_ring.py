@@ -0,0 +1,198 @@
+import threading
+import uuid
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+# 共有メモリの先頭の管理領域 [識別値, リングID, スロット数, スロットの画像領域の大きさ]
+_RING_HEADER_FIELDS = 4
+_RING_MAGIC = 0x52494E47
+# スロットごとの管理領域 [書き込み番号, 高さ, 幅, チャネル数]
+_SLOT_HEADER_FIELDS = 4
+_FIELD_SIZE = np.dtype(np.int64).itemsize
+
+
+def get_frame_ring_name(port):
+    """
+    カメラのポートごとの共有メモリの名前を返す
+    :param port: カメラのポート番号
+    :return: 共有メモリの名前
+    """
+    return f"rixiot_frames_port_{port}"
+
+
+class FrameRing:
+    def __init__(self, shm):
+        """
+        カメラのポートごとに、撮影したフレームを無圧縮のまま共有メモリ上のスロットに順番に上書きしていくリングバッファ。
+        撮影プロセスがcreateで作成して書き込み、画像処理プロセスがattachで接続してコピーせずに読み込む。
+        各スロットの書き込み番号で、読み込むまでに上書きされていないかを確認する
+
+        :param shm: SharedMemory
+        """
+        self._shm = shm
+        header = np.ndarray((_RING_HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        if header[0] != _RING_MAGIC:
+            raise ValueError(f"{shm.name} is not a frame ring")
+        self.ring_id = int(header[1])
+        self.slot_count = int(header[2])
+        self.slot_size = int(header[3])
+        self._slot_headers = np.ndarray((self.slot_count, _SLOT_HEADER_FIELDS), dtype=np.int64, buffer=shm.buf,
+                                        offset=_RING_HEADER_FIELDS * _FIELD_SIZE)
+        self._data_offset = (_RING_HEADER_FIELDS + self.slot_count * _SLOT_HEADER_FIELDS) * _FIELD_SIZE
+        self._next_sequence = int(self._slot_headers[:, 0].max()) + 1
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @classmethod
+    def create(cls, name, slot_count, max_frame_shape):
+        """
+        リングバッファを作成する。同じ名前の古い共有メモリは削除する
+        :param name: 共有メモリの名前
+        :param slot_count: スロット数
+        :param max_frame_shape: 格納できるフレームの最大の形状(高さ, 幅, チャネル数)
+        :return: FrameRing
+        """
+        try:
+            old_shm = shared_memory.SharedMemory(name=name)
+            old_shm.close()
+            old_shm.unlink()
+        except FileNotFoundError:
+            pass
+        slot_size = int(np.prod(max_frame_shape))
+        size = (_RING_HEADER_FIELDS + slot_count * _SLOT_HEADER_FIELDS) * _FIELD_SIZE + slot_count * slot_size
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((_RING_HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = [_RING_MAGIC, uuid.uuid4().int >> 65, slot_count, slot_size]
+        slot_headers = np.ndarray((slot_count, _SLOT_HEADER_FIELDS), dtype=np.int64, buffer=shm.buf,
+                                  offset=_RING_HEADER_FIELDS * _FIELD_SIZE)
+        slot_headers[:] = 0
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        作成済みのリングバッファに接続する
+        :param name: 共有メモリの名前
+        :return: FrameRing
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        # 接続しただけのプロセスの終了で共有メモリが削除されないようにする
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return cls(shm)
+
+    def _slot_data(self, slot_index):
+        return np.ndarray((self.slot_size,), dtype=np.uint8, buffer=self._shm.buf,
+                          offset=self._data_offset + slot_index * self.slot_size)
+
+    def write(self, frame):
+        """
+        フレームを次のスロットに書き込む
+        :param frame: uint8のフレーム
+        :return: (スロット番号, 書き込み番号)。スロットに収まらない場合はNone
+        """
+        if frame.dtype != np.uint8 or frame.nbytes > self.slot_size:
+            return None
+        with self._lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+            slot_index = sequence % self.slot_count
+            slot_header = self._slot_headers[slot_index]
+            # 書き込み中は書き込み番号を0にして、読み込み側が不完全なフレームを使わないようにする
+            slot_header[0] = 0
+            height, width = frame.shape[:2]
+            channels = frame.shape[2] if frame.ndim == 3 else 1
+            slot_header[1:] = [height, width, channels]
+            self._slot_data(slot_index)[:frame.nbytes] = frame.reshape(-1)
+            slot_header[0] = sequence
+        return slot_index, sequence
+
+    def read(self, slot_index, sequence):
+        """
+        スロットのフレームをコピーせずに返す。返した配列は書き込み禁止
+        :param slot_index: スロット番号
+        :param sequence: 書き込み時の書き込み番号
+        :return: フレーム。上書きされている場合はNone
+        """
+        slot_header = self._slot_headers[slot_index]
+        if slot_header[0] != sequence:
+            return None
+        height, width, channels = (int(value) for value in slot_header[1:])
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        frame = self._slot_data(slot_index)[:height * width * channels].reshape(shape)
+        frame.setflags(write=False)
+        return frame
+
+    def is_current(self, slot_index, sequence):
+        """
+        スロットが書き込み時から上書きされていないかを返す
+        :param slot_index: スロット番号
+        :param sequence: 書き込み時の書き込み番号
+        :return: 上書きされていない場合はTrue
+        """
+        return self._slot_headers[slot_index][0] == sequence
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+# プロセスごとに接続済みのリングバッファ
+_attached_rings = {}
+_attached_rings_lock = threading.Lock()
+
+
+def attach_frame_ring(name, ring_id):
+    """
+    リングバッファに接続する。撮影プロセスが作り直した場合は接続し直す
+    :param name: 共有メモリの名前
+    :param ring_id: 通知されたリングID
+    :return: FrameRing。接続できない場合はNone
+    """
+    with _attached_rings_lock:
+        ring = _attached_rings.get(name)
+        if ring is None or ring.ring_id != ring_id:
+            try:
+                ring = FrameRing.attach(name)
+            except (FileNotFoundError, ValueError) as e:
+                print(f"frame ring {name} is not available. {e}")
+                return None
+            _attached_rings[name] = ring
+        return ring if ring.ring_id == ring_id else None
+
+
+def read_ring_frames(ring_reference):
+    """
+    撮影完了通知のリングバッファの参照から、画像ファイルのパスごとのフレームを読み込む
+    :param ring_reference: {"name","ring_id","frames":[[画像ファイルのパス, スロット番号, 書き込み番号],...]}
+    :return: 画像ファイルのパスをキーとしたフレームの辞書。上書きされたフレームは含まない
+    """
+    ring = attach_frame_ring(ring_reference["name"], ring_reference["ring_id"])
+    if ring is None:
+        return {}
+    frames = {}
+    for image_path, slot_index, sequence in ring_reference["frames"]:
+        frame = ring.read(slot_index, sequence)
+        if frame is not None:
+            frames[image_path] = frame
+    return frames
+
+
+def is_ring_reference_current(ring_reference):
+    """
+    リングバッファの参照先のフレームがすべて上書きされていないかを返す
+    :param ring_reference: {"name","ring_id","frames":[[画像ファイルのパス, スロット番号, 書き込み番号],...]}
+    :return: 上書きされていない場合はTrue
+    """
+    ring = attach_frame_ring(ring_reference["name"], ring_reference["ring_id"])
+    if ring is None:
+        return False
+    return all(ring.is_current(slot_index, sequence) for _, slot_index, sequence in ring_reference["frames"])
@@ -1,18 +1,36 @@
+import collections
+import queue
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 
 class EmailSender:
-    def __init__(self, smtp_server, smtp_port, sender_email, sender_password, receiver_emails, subject):
+    def __init__(self, smtp_server, smtp_port, sender_email, sender_password, receiver_emails, subject,
+                 idle_check_sec=None):
+        """
+        :param idle_check_sec: この時間(秒)以上使っていない接続は、送信前にNOOPで切断されていないか確認する。Noneの場合は確認しない
+        """
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
         self.sender_email = sender_email
         self.sender_password = sender_password
         self.receiver_emails = receiver_emails
         self.subject = subject
-
-    def send_email(self, message: str) -> None:
+        self.idle_check_sec = idle_check_sec
+        # ログイン済みのSMTP接続と、最後に使った時刻。次の送信でも使う
+        self._server = None
+        self._last_used_time = 0.0
+
+    def send_email(self, message: str) -> bool:
+        """
+        メールを送る。ログイン済みの接続があれば使い、送信に失敗した場合は接続し直して１回だけ再送する。
+        切断はSMTPServerDisconnectedの他に、SMTPResponseExceptionやソケットのOSErrorで通知されることもある
+        :param message: 本文
+        :return: 送信できた場合はTrue
+        """
         if self.receiver_emails is not None:
             msg = MIMEMultipart()
             msg['From'] = self.sender_email
@@ -22,17 +40,61 @@ class EmailSender:
             msg.attach(MIMEText(message, 'plain'))
 
             try:
-                server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-                server.starttls()
-                server.login(self.sender_email, self.sender_password)
-                server.send_message(msg)
-                server.quit()
+                try:
+                    self._get_server().send_message(msg)
+                except OSError as e:
+                    # SMTPExceptionもOSErrorのサブクラス
+                    print(f"reconnect and resend email: {e}")
+                    self.close()
+                    self._get_server().send_message(msg)
+                self._last_used_time = time.monotonic()
                 print("Email sent successfully!")
+                return True
             except Exception as e:
                 print(e)
+                self.close()
                 # import traceback
                 # with open("/home/pi/ble/mail_exception.txt", 'a') as f:
                 # traceback.print_exc(file=f)
+        return False
+
+    def _get_server(self):
+        if self._server is not None and self.idle_check_sec is not None \
+                and time.monotonic() - self._last_used_time > self.idle_check_sec and not self._is_server_alive():
+            print("SMTP connection was closed while idle. reconnect")
+            self.close()
+        if self._server is None:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+            server.starttls()
+            server.login(self.sender_email, self.sender_password)
+            self._server = server
+            self._last_used_time = time.monotonic()
+        return self._server
+
+    def _is_server_alive(self):
+        """
+        NOOPで接続が使えるか確認する
+        :return: 使える場合はTrue
+        """
+        try:
+            code, _ = self._server.noop()
+        except OSError:
+            return False
+        return code == 250
+
+    def close(self):
+        """
+        SMTP接続を閉じる
+        """
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception as e:
+            print(e)
+            # QUITを送れなかった場合もソケットは閉じる
+            self._server.close()
+        self._server = None
 
 
 class EmailMessageCreator:
@@ -61,3 +123,72 @@ class EmailMessagePool:
         self.messages = []
 
 
+class EmailDispatcher(threading.Thread):
+    def __init__(self, load_email_sender, digest_window_sec, max_send_count, send_count_period_sec):
+        """
+        アラートメールを画像処理とは別のスレッドで送る。
+        最初のメッセージからdigest_window_sec秒の間に届いたメッセージを１通のメールにまとめ、
+        send_count_period_sec秒の間に送るメールをmax_send_count通までにする
+
+        :param load_email_sender: 送信時に使うEmailSenderを返す関数
+        :param digest_window_sec: メッセージをまとめる時間(秒)
+        :param max_send_count: 期間内に送るメールの最大数
+        :param send_count_period_sec: 送信数を数える期間(秒)
+        """
+        super().__init__(daemon=True)
+        self._load_email_sender = load_email_sender
+        self.digest_window_sec = digest_window_sec
+        self.max_send_count = max_send_count
+        self.send_count_period_sec = send_count_period_sec
+        self._queue = queue.Queue()
+        self._send_times = collections.deque()
+        self._email_sender = None
+
+    def put(self, message):
+        """
+        メッセージを送信待ちにしてすぐに戻る
+        :param message: 本文
+        """
+        if message != "":
+            self._queue.put(message)
+
+    def run(self):
+        while True:
+            messages = [self._queue.get()]
+            deadline = time.monotonic() + self.digest_window_sec
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    messages.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # ウインドウ内に届かなかった分もキューにあればまとめる
+            while True:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.send_digest("".join(messages))
+
+    def send_digest(self, message):
+        """
+        送信数の上限内であればメールを送る
+        :param message: 本文
+        """
+        now = time.monotonic()
+        while self._send_times and now - self._send_times[0] >= self.send_count_period_sec:
+            self._send_times.popleft()
+        if len(self._send_times) >= self.max_send_count:
+            print(f"アラートメールの送信数が上限({self.max_send_count}通)に達したため送信しません")
+            print(message)
+            return
+        email_sender = self._load_email_sender()
+        if email_sender is not self._email_sender:
+            # 設定が変わった場合は古い接続を閉じる
+            if self._email_sender is not None:
+                self._email_sender.close()
+            self._email_sender = email_sender
+        if email_sender.send_email(message):
+            self._send_times.append(now)
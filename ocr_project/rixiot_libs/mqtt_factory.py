@@ -1,8 +1,7 @@
-import time
+import sqlite3
+import threading
 from paho.mqtt import client as mqtt_client
 
-RECONNECT_RATE_SEC = 10
-
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -12,24 +11,22 @@ def on_connect(client, userdata, flags, rc):
 
 
 def on_disconnect(client, userdata, rc):
-    while True:
-        time.sleep(RECONNECT_RATE_SEC)
-        try:
-            client.reconnect()
-            print("再接続に成功しました！")
-            return
-        except Exception as e:
-            print("%s。再接続に失敗しました。再試行します...", e)
+    # 再接続はネットワークループ(loop_start)がreconnect_delay_setの間隔で行う
+    if rc != 0:
+        print("MQTTブローカーとの接続が切れました。再接続します...リターンコード", rc)
 
 
 class MQTTClientFactory:
 
-    def __init__(self, user_name, password, on_connect, on_disconnect, on_message):
+    def __init__(self, user_name, password, on_connect, on_disconnect, on_message, reconnect_min_delay_sec=1,
+                 reconnect_max_delay_sec=120):
         self.user_name = user_name
         self.password = password
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
         self.on_message = on_message
+        self.reconnect_min_delay_sec = reconnect_min_delay_sec
+        self.reconnect_max_delay_sec = reconnect_max_delay_sec
 
     def create(self):
         client = mqtt_client.Client()
@@ -39,4 +36,214 @@ class MQTTClientFactory:
         client.on_connect = self.on_connect
         client.on_disconnect = self.on_disconnect
         client.on_message = self.on_message
+        # 再接続に失敗するたびに待ち時間を倍にする
+        client.reconnect_delay_set(min_delay=self.reconnect_min_delay_sec, max_delay=self.reconnect_max_delay_sec)
         return client
+
+
+class MQTTOutbox:
+    def __init__(self, path, max_count):
+        """
+        ブローカーに送れなかったメッセージを送信順にSQLiteのファイルに保存する。
+        max_countを超えた場合は古いメッセージから捨てる
+
+        :param path: SQLiteのファイルパス
+        :param max_count: 保存するメッセージの最大数
+        """
+        self.path = path
+        self.max_count = max_count
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS outbox "
+                                 "(id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, message TEXT NOT NULL)")
+        self._lock = threading.Lock()
+
+    def put(self, topic, message):
+        """
+        メッセージを末尾に加える
+        :param topic: 送信先トピック
+        :param message: メッセージ
+        """
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute("INSERT INTO outbox (topic, message) VALUES (?, ?)", (topic, message))
+            self._connection.execute("DELETE FROM outbox WHERE id <= (SELECT MAX(id) FROM outbox) - ?",
+                                     (self.max_count,))
+
+    def peek(self, count):
+        """
+        古い順にメッセージを返す。返したメッセージは削除しない
+        :param count: 返す最大数
+        :return: (id, トピック, メッセージ)の配列
+        """
+        with self._lock:
+            return self._connection.execute("SELECT id, topic, message FROM outbox ORDER BY id LIMIT ?",
+                                            (count,)).fetchall()
+
+    def remove(self, ids):
+        """
+        送信済みのメッセージを削除する
+        :param ids: peekで返したid
+        """
+        if not ids:
+            return
+        with self._lock:
+            self._connection.execute(f"DELETE FROM outbox WHERE id IN ({','.join('?' * len(ids))})", list(ids))
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+class MQTTPublisher:
+    def __init__(self, client, broker_ip, broker_port, keep_alive, topic, outbox=None, flush_batch_size=100):
+        """
+        ブローカーとの接続を保ったまま、バックグラウンドのネットワークループで送信する。
+        送信のたびに接続と切断を繰り返さない。
+        outboxがある場合、接続していない間のメッセージはoutboxに保存し、再接続後に別スレッドから送信順に送る
+
+        :param client: paho.mqtt.client.Client
+        :param broker_ip: ブローカーのIPアドレス
+        :param broker_port: ブローカーのポート番号
+        :param keep_alive: キープアライブ(秒)
+        :param topic: 既定の送信先トピック
+        :param outbox: MQTTOutbox。Noneの場合、接続していない間のメッセージは捨てる
+        :param flush_batch_size: outboxから１回に読み出して送るメッセージ数
+        """
+        self.client = client
+        self.broker_ip = broker_ip
+        self.broker_port = broker_port
+        self.keep_alive = keep_alive
+        self.topic = topic
+        self.outbox = outbox
+        self.flush_batch_size = flush_batch_size
+        self._is_started = False
+        self._lock = threading.Lock()
+        # outboxに未送信のメッセージがある間は、順序を保つため新しいメッセージもoutboxに入れる
+        self._outbox_lock = threading.Lock()
+        self._has_outbox_messages = outbox is not None and outbox.count() > 0
+        self._flush_event = threading.Event()
+        self._on_connect = client.on_connect
+        if outbox is not None:
+            client.on_connect = self._handle_connect
+            threading.Thread(target=self._flush_outbox, daemon=True).start()
+
+    def start(self):
+        """
+        ブローカーへの接続とネットワークループを開始する。開始済みの場合は何もしない
+        """
+        with self._lock:
+            if self._is_started:
+                return
+            self.client.connect_async(self.broker_ip, self.broker_port, self.keep_alive)
+            self.client.loop_start()
+            self._is_started = True
+
+    def publish(self, message, topic=None):
+        """
+        メッセージを送信キューに入れてすぐに戻る
+        :param message: メッセージ
+        :param topic: 送信先トピック。Noneの場合は既定のトピック
+        :return: paho.mqtt.client.MQTTMessageInfo
+        """
+        self.start()
+        topic = self.topic if topic is None else topic
+        if self.outbox is None:
+            return self.client.publish(topic, message)
+        with self._outbox_lock:
+            if not self._has_outbox_messages and self.client.is_connected():
+                message_info = self.client.publish(topic, message)
+                if message_info.rc == mqtt_client.MQTT_ERR_SUCCESS:
+                    return message_info
+            self.outbox.put(topic, message)
+            self._has_outbox_messages = True
+        if self.client.is_connected():
+            self._flush_event.set()
+        return None
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if self._on_connect is not None:
+            self._on_connect(client, userdata, flags, rc)
+        if rc == 0:
+            self._flush_event.set()
+
+    def _flush_outbox(self):
+        """
+        接続している間、outboxのメッセージをflush_batch_sizeずつ送る
+        """
+        while True:
+            self._flush_event.wait()
+            self._flush_event.clear()
+            while self.client.is_connected():
+                with self._outbox_lock:
+                    messages = self.outbox.peek(self.flush_batch_size)
+                    if not messages:
+                        self._has_outbox_messages = False
+                        break
+                sent_ids = []
+                for message_id, topic, message in messages:
+                    if self.client.publish(topic, message).rc != mqtt_client.MQTT_ERR_SUCCESS:
+                        break
+                    sent_ids.append(message_id)
+                self.outbox.remove(sent_ids)
+                if len(sent_ids) < len(messages):
+                    break
+
+    def stop(self):
+        """
+        ネットワークループを止めて切断する
+        """
+        with self._lock:
+            if not self._is_started:
+                return
+            self.client.disconnect()
+            self.client.loop_stop()
+            self._is_started = False
+
+
+class MQTTMessageBatcher:
+    def __init__(self, publish, load_expected_ports, timeout_sec):
+        """
+        同じ撮影時刻の全カメラのメッセージを集め、１回の送信にまとめる。
+        処理されないカメラがあっても、最初のメッセージからtimeout_sec後には集まった分を送る
+
+        :param publish: まとめたメッセージを送る関数 publish(timestamp, messages)
+        :param load_expected_ports: 撮影時刻ごとにメッセージを待つカメラのポート番号の集合を返す関数
+        :param timeout_sec: 全カメラのメッセージを待つ最大時間(秒)
+        """
+        self._publish = publish
+        self._load_expected_ports = load_expected_ports
+        self._timeout_sec = timeout_sec
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, timestamp, port, messages):
+        """
+        カメラ１台分のメッセージを加える。全カメラのメッセージが揃ったら送る
+        :param timestamp: 撮影時刻
+        :param port: カメラのポート番号
+        :param messages: メッセージの配列
+        """
+        with self._lock:
+            batch = self._batches.get(timestamp)
+            if batch is None:
+                timer = threading.Timer(self._timeout_sec, self._flush, args=(timestamp,))
+                timer.daemon = True
+                batch = {"ports": set(), "messages": [], "timer": timer}
+                self._batches[timestamp] = batch
+                timer.start()
+            batch["ports"].add(str(port))
+            batch["messages"].extend(messages)
+            is_complete = batch["ports"] >= {str(expected_port) for expected_port in self._load_expected_ports()}
+        if is_complete:
+            self._flush(timestamp)
+
+    def _flush(self, timestamp):
+        with self._lock:
+            batch = self._batches.pop(timestamp, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        if batch["messages"]:
+            self._publish(timestamp, batch["messages"])
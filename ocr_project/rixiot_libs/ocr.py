@@ -1,20 +1,67 @@
 # 標準ライブラリ
+import copy
+import functools
+import json
 import os
+import re
+import shlex
+import threading
 import numpy as np
 import collections
 # サードパーティーライブラリ
 import cv2
 from PIL import Image
 import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 # 自作モジュール
 import uuid
 from common_libs.schema import Coordinate
 
 
+# 縮小率ごとのcv2.imreadの読み込みフラグ。JPEGは縮小率に応じてDCTの段階で縮小して復号される
+REDUCED_IMREAD_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
 def load_image(image_path):
     return cv2.imread(image_path)
 
 
+def load_image_region(image_path, bounding_box, reduction=1):
+    """
+    画像ファイルを縮小率reductionで読み込み、bounding_boxの範囲を切り出す
+    :param image_path: 画像ファイルのパス
+    :param bounding_box: 元の画像上の切り出す範囲(左上X,左上Y,右下X,右下Y)
+    :param reduction: 縮小率 1,2,4,8のいずれか
+    :return: (切り出した画像(読み込んだ画像のビュー), 縮小後の画像上の切り出し範囲の左上座標(x,y))。読み込めない場合は(None, None)
+    """
+    image = cv2.imread(image_path, REDUCED_IMREAD_FLAGS[reduction])
+    if image is None:
+        return None, None
+    return crop_image_region(image, bounding_box, reduction)
+
+
+def crop_image_region(image, bounding_box, reduction=1):
+    """
+    縮小率reductionで読み込まれた画像から、bounding_boxの範囲を切り出す
+    :param image: 縮小率reductionで読み込まれた画像
+    :param bounding_box: 元の画像上の切り出す範囲(左上X,左上Y,右下X,右下Y)
+    :param reduction: 画像の縮小率
+    :return: (切り出した画像(入力画像のビュー), 縮小後の画像上の切り出し範囲の左上座標(x,y))
+    """
+    height, width = image.shape[:2]
+    left_x, left_y, right_x, right_y = bounding_box
+    left_x = min(max(left_x // reduction, 0), width)
+    left_y = min(max(left_y // reduction, 0), height)
+    right_x = min(max(-(-right_x // reduction), left_x), width)
+    right_y = min(max(-(-right_y // reduction), left_y), height)
+    return image[left_y:right_y, left_x:right_x], (left_x, left_y)
+
+
 def get_perspective_image(corner_points, image):
     """
     入力画像を４隅の入力点を基に、射影変換し、射影変換された画像を出力する
@@ -22,24 +69,297 @@ def get_perspective_image(corner_points, image):
     :param image: 入力画像
     :return: 射影変換された画像
     """
-    # Extract corner points
-    p1, p2, p3, p4 = [corner_points[i:i + 2] for i in range(0, len(corner_points), 2)]
+    return get_perspective_geometry(corner_points).warp(image)
 
-    # Compute widths and heights of the new image
-    width = int(max(np.linalg.norm(np.array(p2) - np.array(p1)),
-                    np.linalg.norm(np.array(p4) - np.array(p3))))
-    height = int(max(np.linalg.norm(np.array(p3) - np.array(p2)),
-                     np.linalg.norm(np.array(p4) - np.array(p1))))
 
-    # Source and destination points for perspective transformation
-    src = np.float32([p1, p2, p3, p4])
-    dst = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+class PerspectiveGeometry:
+    """
+    ４隅の座標から求めた射影変換行列と出力画像の大きさ、cv2.remap用の座標表を保持する
+    """
+
+    def __init__(self, corner_points, output_height=None, source_scale=1.0):
+        """
+        :param corner_points: 射影変換に必要な画像上の４隅の座標["左上X","左上Y","右上X","右上Y","右下X","右下Y","左下X","左下Y"]
+        :param output_height: 出力画像の高さ(px)。Noneの場合は４隅の座標から求めた大きさのまま出力する
+        :param source_scale: 設定画面の画像に対する入力画像の倍率。撮影解像度を下げた場合に1未満になる
+        """
+        # Extract corner points
+        p1, p2, p3, p4 = [corner_points[i:i + 2] for i in range(0, len(corner_points), 2)]
+
+        # Compute widths and heights of the new image
+        width = int(max(np.linalg.norm(np.array(p2) - np.array(p1)),
+                        np.linalg.norm(np.array(p4) - np.array(p3))))
+        height = int(max(np.linalg.norm(np.array(p3) - np.array(p2)),
+                         np.linalg.norm(np.array(p4) - np.array(p1))))
+        # 設定画面の座標は４隅の座標から求めた大きさの画像上の座標なので、出力画像との倍率を保持する
+        self.scale = output_height / height if output_height and height > 0 else 1.0
+        self.width = max(1, int(round(width * self.scale)))
+        self.height = max(1, int(round(height * self.scale)))
+        # 出力画像の大きさは設定画面の座標で決め、入力画像上の４隅の座標だけを撮影解像度に合わせる
+        self.source_scale = source_scale
+        if source_scale != 1.0:
+            p1, p2, p3, p4 = [[value * source_scale for value in point] for point in (p1, p2, p3, p4)]
+        # 射影変換で参照する入力画像の範囲。バイリニア補間で参照する隣の画素の分だけ広げる
+        xs = [point[0] for point in (p1, p2, p3, p4)]
+        ys = [point[1] for point in (p1, p2, p3, p4)]
+        self.bounding_box = (int(np.floor(min(xs))) - 2, int(np.floor(min(ys))) - 2,
+                             int(np.ceil(max(xs))) + 2, int(np.ceil(max(ys))) + 2)
+        # 出力画像が縮小される場合は、縮小率以下の範囲で入力画像を縮小して読み込む
+        self.reduction = max([reduction for reduction in REDUCED_IMREAD_FLAGS
+                              if reduction * self.scale <= source_scale],
+                             default=1)
+        self._source_geometries = {}
+
+        # Source and destination points for perspective transformation
+        src = np.float32([p1, p2, p3, p4])
+        dst = np.float32([[0, 0], [self.width, 0], [self.width, self.height], [0, self.height]])
+        self.matrix = cv2.getPerspectiveTransform(src, dst)
+        self._map1, self._map2 = self._create_remap_tables()
+
+    def _create_remap_tables(self):
+        """
+        出力画像の各画素に対応する入力画像上の座標を求め、cv2.remap用の固定小数点の座標表にする
+        :return: cv2.remap用の座標表(map1, map2)
+        """
+        xs, ys = np.meshgrid(np.arange(self.width, dtype=np.float64), np.arange(self.height, dtype=np.float64))
+        inverse_matrix = np.linalg.inv(self.matrix)
+        denominator = inverse_matrix[2, 0] * xs + inverse_matrix[2, 1] * ys + inverse_matrix[2, 2]
+        map_x = ((inverse_matrix[0, 0] * xs + inverse_matrix[0, 1] * ys + inverse_matrix[0, 2]) / denominator)
+        map_y = ((inverse_matrix[1, 0] * xs + inverse_matrix[1, 1] * ys + inverse_matrix[1, 2]) / denominator)
+        return cv2.convertMaps(map_x.astype(np.float32), map_y.astype(np.float32), cv2.CV_16SC2)
+
+    def for_source(self, reduction=1, offset=(0, 0)):
+        """
+        縮小して読み込み、切り出した入力画像を射影変換するためのPerspectiveGeometryを返す。
+        同じ縮小率と切り出し位置の組は一度だけ作成して使い回す
+        :param reduction: 入力画像の縮小率
+        :param offset: 縮小後の画像上の切り出し範囲の左上座標(x,y)
+        :return: PerspectiveGeometry
+        """
+        key = (reduction, tuple(offset))
+        if key == (1, (0, 0)):
+            return self
+        geometry = self._source_geometries.get(key)
+        if geometry is None:
+            # 縮小後の画素の中心は元の画像の reduction*x + (reduction-1)/2 にあたる
+            shift = (reduction - 1) / (2 * reduction)
+            source_matrix = np.array([[1 / reduction, 0, -shift - offset[0]],
+                                      [0, 1 / reduction, -shift - offset[1]],
+                                      [0, 0, 1]])
+            geometry = copy.copy(self)
+            geometry.matrix = self.matrix @ np.linalg.inv(source_matrix)
+            geometry._map1, geometry._map2 = geometry._create_remap_tables()
+            geometry._source_geometries = {}
+            self._source_geometries[key] = geometry
+        return geometry
+
+    def warp(self, image, dst=None):
+        """
+        入力画像を射影変換する
+        :param image: 入力画像
+        :param dst: 出力先の画像。Noneの場合は新しく確保する
+        :return: 射影変換された画像
+        """
+        return cv2.remap(image, self._map1, self._map2, cv2.INTER_LINEAR, dst=dst)
 
-    # Compute the perspective transformation matrix and apply it
-    transformation_matrix = cv2.getPerspectiveTransform(src, dst)
-    transformed_image = cv2.warpPerspective(image, transformation_matrix, (width, height))
 
-    return transformed_image
+@functools.lru_cache(maxsize=32)
+def _compile_perspective_geometry(corner_points, output_height, source_scale):
+    return PerspectiveGeometry(corner_points, output_height=output_height, source_scale=source_scale)
+
+
+def get_perspective_geometry(corner_points, output_height=None, source_scale=1.0):
+    """
+    ４隅の座標に対応する射影変換を返す。同じ座標の射影変換は一度だけ作成して使い回す
+    :param corner_points: 射影変換に必要な画像上の４隅の座標
+    :param output_height: 出力画像の高さ(px)。Noneの場合は４隅の座標から求めた大きさ
+    :param source_scale: 設定画面の画像に対する入力画像の倍率
+    :return: PerspectiveGeometry
+    """
+    return _compile_perspective_geometry(tuple(corner_points), output_height, source_scale)
+
+
+class DisplayGeometry:
+    """
+    表示領域の射影変換と、射影変換後の画像上の桁領域・認識点・小数点座標をまとめて保持する
+    """
+
+    def __init__(self, corner_points, segment_regions, recognition_points, decimal_points, canonical_height=None,
+                 source_scale=1.0):
+        """
+        :param corner_points: 表示領域の４隅の座標
+        :param segment_regions: 桁数分の７セグメントの領域座標[{"region_left_x",...}]
+        :param recognition_points: 桁数分の７セグメントの認識点座標[[[x,y],...]]
+        :param decimal_points: 小数点の認識点座標[{"decimal_x","decimal_y"}]
+        :param canonical_height: 射影変換後の表示領域の高さ(px)。Noneの場合は４隅の座標から求めた大きさのまま
+        :param source_scale: 設定画面の画像に対する入力画像の倍率。桁領域などの座標は射影変換後の画像上なので変わらない
+        """
+        self.perspective = get_perspective_geometry(corner_points, output_height=canonical_height,
+                                                    source_scale=source_scale)
+        scale = self.perspective.scale
+        self.segment_regions = [(self._scale(region["region_left_x"], scale),
+                                 self._scale(region["region_left_y"], scale),
+                                 self._scale(region["region_right_x"], scale),
+                                 self._scale(region["region_right_y"], scale))
+                                for region in segment_regions]
+        # 認識点は桁領域の左上を原点とした座標にする。縮小した場合は丸めで桁領域からはみ出さないようにする
+        self.ocr_points = [[Coordinate(x=self._scale_in_region(point[0], scale, left_x, right_x),
+                                       y=self._scale_in_region(point[1], scale, left_y, right_y))
+                            for point in points]
+                           for (left_x, left_y, right_x, right_y), points in zip(self.segment_regions,
+                                                                                 recognition_points)]
+        self.point_ys, self.point_xs = to_point_arrays(self.ocr_points)
+        # 小数点も縮小した場合は丸めで出力画像からはみ出さないようにする
+        self.decimal_points = [Coordinate(x=self._scale_in_region(point["decimal_x"], scale, 0, self.perspective.width),
+                                          y=self._scale_in_region(point["decimal_y"], scale, 0,
+                                                                  self.perspective.height))
+                               for point in decimal_points]
+
+    @staticmethod
+    def _scale(value, scale):
+        """
+        設定画面の座標を出力画像の座標にする
+        :param value: 設定画面の座標
+        :param scale: 出力画像の倍率
+        :return: 出力画像の座標
+        """
+        if scale == 1.0:
+            return int(value)
+        return int(round(int(value) * scale))
+
+    @classmethod
+    def _scale_in_region(cls, value, scale, region_start, region_end):
+        """
+        設定画面の認識点座標を、出力画像の桁領域の始点を原点とした座標にする
+        :param value: 設定画面の座標
+        :param scale: 出力画像の倍率
+        :param region_start: 出力画像での桁領域の始点
+        :param region_end: 出力画像での桁領域の終点
+        :return: 桁領域の始点を原点とした座標
+        """
+        position = cls._scale(value, scale) - region_start
+        if scale == 1.0:
+            return position
+        return min(max(position, 0), max(region_end - region_start - 1, 0))
+
+    def warp(self, image, dst=None):
+        """
+        入力画像から表示領域を射影変換して切り出す
+        :param image: 入力画像
+        :param dst: 出力先の画像。Noneの場合は新しく確保する
+        :return: 射影変換された表示領域の画像
+        """
+        return self.perspective.warp(image, dst=dst)
+
+    def load_region(self, image_path):
+        """
+        画像ファイルから表示領域を含む範囲だけを、出力画像の大きさが許す範囲で縮小して読み込む
+        :param image_path: 画像ファイルのパス
+        :return: (読み込んだ範囲の画像, その画像用のPerspectiveGeometry)。読み込めない場合は(None, None)
+        """
+        reduction = self.perspective.reduction
+        region_image, offset = load_image_region(image_path, self.perspective.bounding_box, reduction)
+        if region_image is None:
+            return None, None
+        return region_image, self.perspective.for_source(reduction, offset)
+
+    def crop_region(self, frame, reduction):
+        """
+        読み込み済みのフレームから表示領域を含む範囲を切り出す
+        :param frame: 縮小率reductionで読み込まれたフレーム
+        :param reduction: フレームの縮小率
+        :return: (切り出した範囲の画像, その画像用のPerspectiveGeometry)
+        """
+        region_image, offset = crop_image_region(frame, self.perspective.bounding_box, reduction)
+        return region_image, self.perspective.for_source(reduction, offset)
+
+
+class FrameCache:
+    def __init__(self, image_paths, reduction=1, frames=None):
+        """
+        １回の撮影分のフレームを一度だけ読み込み、同じカメラの全設定で共有する。
+        読み込んだフレームは書き込み禁止にするので、各設定の処理で変更されない
+
+        :param image_paths: フレームの画像ファイルのパスの配列
+        :param reduction: 読み込み時の縮小率。共有する設定が必要とする縮小率のうち最小のもの
+        :param frames: 読み込み済みの縮小率reductionのフレームの辞書{画像ファイルのパス: フレーム}
+        """
+        self.image_paths = list(image_paths)
+        self.reduction = reduction
+        self._frames = dict(frames) if frames else {}
+        self._lock = threading.Lock()
+
+    def load(self, image_path):
+        """
+        フレームを返す。初回だけ画像ファイルから読み込む
+        :param image_path: 画像ファイルのパス
+        :return: 縮小率reductionで読み込まれたフレーム。読み込めない場合はNone
+        """
+        with self._lock:
+            if image_path not in self._frames:
+                frame = cv2.imread(image_path, REDUCED_IMREAD_FLAGS[self.reduction])
+                if frame is not None:
+                    frame.setflags(write=False)
+                self._frames[image_path] = frame
+            return self._frames[image_path]
+
+
+@functools.lru_cache(maxsize=64)
+def compile_display_geometry(perspective_transformation_setting, segment_region_settings,
+                             segment_recognition_points, decimal_point_setting, canonical_height=None,
+                             source_scale=1.0):
+    """
+    ＤＢに保存された設定のJSON文字列から表示領域の幾何情報を作成する。
+    同じ設定内容(設定の版)に対しては一度だけ作成して使い回す
+    :param perspective_transformation_setting: 表示領域の４隅の座標のJSON文字列
+    :param segment_region_settings: 桁領域のJSON文字列
+    :param segment_recognition_points: 認識点座標のJSON文字列
+    :param decimal_point_setting: 小数点の認識点座標のJSON文字列
+    :param canonical_height: 射影変換後の表示領域の高さ(px)。Noneの場合は４隅の座標から求めた大きさのまま
+    :param source_scale: 設定画面の画像に対する入力画像の倍率
+    :return: DisplayGeometry
+    """
+    return DisplayGeometry(corner_points=json.loads(perspective_transformation_setting),
+                           segment_regions=json.loads(segment_region_settings),
+                           recognition_points=json.loads(segment_recognition_points),
+                           decimal_points=json.loads(decimal_point_setting),
+                           canonical_height=canonical_height,
+                           source_scale=source_scale)
+
+
+def read_image_size(image_path):
+    """
+    画像ファイルのヘッダーから画像の大きさを読み込む。画素は復号しない
+    :param image_path: 画像ファイルのパス
+    :return: (幅, 高さ)。読み込めない場合はNone
+    """
+    try:
+        with Image.open(image_path) as image:
+            return image.size
+    except (OSError, ValueError):
+        return None
+
+
+def calculate_capture_resolution(corner_points_list, reference_size, resolutions, canonical_heights):
+    """
+    カメラの全設定の表示領域を、射影変換後の高さ以上の解像度で写せる最小の撮影解像度を求める
+    :param corner_points_list: 設定ごとの表示領域の４隅の座標の配列
+    :param reference_size: 設定画面の画像の大きさ(幅, 高さ)
+    :param resolutions: 撮影解像度の候補(幅, 高さ)の配列。設定画面の画像と縦横比が同じものだけを使う
+    :param canonical_heights: 設定ごとの射影変換後の表示領域の高さ(px)の配列。Noneの設定は設定画面の画像と同じ解像度が必要
+    :return: 撮影解像度(幅, 高さ)。候補に適したものが無い場合はNone
+    """
+    reference_width, reference_height = reference_size
+    required_scale = 0.0
+    for corner_points, canonical_height in zip(corner_points_list, canonical_heights):
+        perspective = get_perspective_geometry(corner_points, output_height=canonical_height)
+        required_scale = max(required_scale, min(perspective.scale, 1.0))
+    if required_scale <= 0.0:
+        return None
+    candidates = [(width, height) for width, height in resolutions
+                  if width * reference_height == height * reference_width
+                  and width >= reference_width * required_scale]
+    return min(candidates, default=None)
 
 
 def calculate_difference_color(on_bgr_colors, off_bgr_colors):
@@ -104,6 +424,37 @@ def to_gray_image(bgr_image):
     return bgr_image
 
 
+def calculate_projection_matrix(on_bgr_colors, off_bgr_colors, is_inverted):
+    """
+    点灯セグメントと消灯セグメントのBGR値の差分方向へ射影してグレースケール化するための変換行列を求める
+    :param on_bgr_colors: 点灯セグメントのＢＧＲ配列[255,21,15]
+    :param off_bgr_colors: 消灯セグメントのBGR配列[6,2,1]
+    :param is_inverted: 前処理で画像の明暗を反転している場合はTrue
+    :return: cv2.transform用の1x4の変換行列(B,G,Rの重みとオフセット)
+    """
+    direction = np.array(on_bgr_colors, dtype=np.float64) - np.array(off_bgr_colors, dtype=np.float64)
+    if is_inverted:
+        direction = -direction
+    norm = np.sum(np.abs(direction))
+    if norm == 0:
+        # 点灯色と消灯色が同じ場合は輝度で白黒にする
+        return np.float32([[0.114, 0.587, 0.299, 0]])
+    weights = direction / norm
+    # 負の重みがあっても出力が0～255に収まるようにオフセットを加える
+    offset = 255.0 * np.sum(np.abs(weights[weights < 0]))
+    return np.float32([[weights[0], weights[1], weights[2], offset]])
+
+
+def to_gray_image_by_projection(bgr_image, projection_matrix):
+    """
+    カラー画像を点灯色と消灯色の差分方向へ射影して白黒画像にする
+    :param bgr_image: カラー画像
+    :param projection_matrix: calculate_projection_matrixで求めた変換行列
+    :return: 白黒画像
+    """
+    return cv2.transform(bgr_image, projection_matrix)
+
+
 def normalize_gray_image(gray_image):
     """
     ２値化を適切にするために、白黒画像の輝度を正規化する
@@ -147,9 +498,8 @@ def roi_image(image, p_left_x, p_left_y, p_right_x, p_right_y):
     :param image: 画像
     :param p_left:左上点(x,y)
     :param p_right: 右上点(x,y)
-    :return: 左上点p_leftと右下点p_rightで指定される長方形領域の画像
+    :return: 左上点p_leftと右下点p_rightで指定される長方形領域の画像(入力画像のビュー)
     """
-    image = image.copy()
     return image[p_left_y: p_right_y, p_left_x: p_right_x]
 
 
@@ -165,12 +515,220 @@ def save_image(image, path):
     cv2.imwrite(path, image)
 
 
+def create_normalize_table(channel_ranges, is_inverted):
+    """
+    チャネルごとの輝度の正規化(cv2.normalizeのNORM_MINMAX相当)と明暗の反転を１回で行うためのルックアップテーブルを作る
+    :param channel_ranges: B,G,Rチャネルごとの(最小値, 最大値)
+    :param is_inverted: Trueの場合は正規化後に明暗を反転する
+    :return: cv2.LUT用の1x256x3のテーブル
+    """
+    levels = np.arange(256, dtype=np.uint8)
+    table = np.empty((1, 256, 3), dtype=np.uint8)
+    for channel, (mi, ma) in enumerate(channel_ranges):
+        # 最小値と最大値が画像と同じ階調の配列をcv2.normalizeすることで、丸めも含めて同じ変換にする
+        channel_levels = np.clip(levels, mi, ma).astype(np.uint8)
+        table[0, :, channel] = cv2.normalize(channel_levels, None, alpha=0, beta=255,
+                                             norm_type=cv2.NORM_MINMAX).ravel()
+    if is_inverted:
+        np.subtract(255, table, out=table)
+    return table
+
+
+def create_gray_normalize_table(gray_image):
+    """
+    白黒画像の輝度の正規化(normalize_gray_image相当)を行うためのルックアップテーブルを作る
+    :param gray_image: 白黒画像(uint8)
+    :return: cv2.LUT用の256要素のテーブル
+    """
+    mi, ma, _, _ = cv2.minMaxLoc(gray_image)
+    if ma == mi:
+        return np.zeros(256, dtype=np.uint8)
+    levels = np.arange(256, dtype=np.float64)
+    return np.clip(255.0 * (levels - mi) / (ma - mi), 0, 255).astype(np.uint8)
+
+
+class ImagePreprocessor:
+    def __init__(self, display_geometry, on_color, off_color, is_off_segment_color,
+                 gray_conversion_method="decolor"):
+        """
+        入力画像から表示領域を切り出し、OCR用の正規化された白黒画像にする。
+        途中の画像はuint8のまま、設定ごとに確保した作業領域へ書き込む
+
+        :param display_geometry: ７セグ表示領域の射影変換
+        :param on_color: 点灯セグメントBGR値
+        :param off_color: 消灯セグメントBGR値
+        :param is_off_segment_color: Trueの場合、消灯セグメント色を差分する
+        :param gray_conversion_method: グレースケール変換方法 "decolor"または"projection"
+        """
+        self._display_geometry = display_geometry
+        self._gray_conversion_method = gray_conversion_method
+        self._is_inverted = np.sum(off_color) > np.sum(on_color)
+        self._projection_matrix = calculate_projection_matrix(on_color, off_color, self._is_inverted)
+        self._difference_color = None
+        if is_off_segment_color:
+            b, g, r = (int(value) for value in calculate_difference_color(on_color, off_color))
+            self._difference_color = (b, g, r, 0)
+        self._buffers = {}
+
+    def _buffer(self, name, shape):
+        """
+        作業領域を返す。形状が変わった場合だけ確保し直す
+        :param name: 作業領域の名前
+        :param shape: 画像の形状
+        :return: uint8の作業領域
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            self._buffers[name] = buffer
+        return buffer
+
+    def to_normalized_color_image(self, bgr_image, perspective=None):
+        """
+        入力画像から表示領域を切り出し、消灯セグメント色の差分と輝度の正規化をしたカラー画像を返す。
+        返す画像は作業領域なので、次の呼び出しで上書きされる
+
+        :param bgr_image: 入力カラー画像
+        :param perspective: 入力画像用のPerspectiveGeometry。Noneの場合は元の大きさの入力画像用
+        :return: 点灯セグメントが明るくなるように正規化されたカラー画像
+        """
+        return self.normalize_color_image(self.warp(bgr_image, perspective=perspective))
+
+    def warp(self, bgr_image, perspective=None, dst=None):
+        """
+        入力画像から表示領域を射影変換して切り出す
+        :param bgr_image: 入力カラー画像
+        :param perspective: 入力画像用のPerspectiveGeometry。Noneの場合は元の大きさの入力画像用
+        :param dst: 出力先の画像。Noneの場合は作業領域に書き込む
+        :return: 射影変換された表示領域の画像
+        """
+        perspective = perspective or self._display_geometry.perspective
+        if dst is None:
+            dst = self._buffer("perspective", (perspective.height, perspective.width, 3))
+        return perspective.warp(bgr_image, dst=dst)
+
+    def normalize_color_image(self, perspective_image):
+        """
+        射影変換された表示領域の画像に、消灯セグメント色の差分と輝度の正規化をする。
+        入力画像は変更せず、作業領域に書き込んだ画像を返す
+
+        :param perspective_image: 射影変換された表示領域の画像
+        :return: 点灯セグメントが明るくなるように正規化されたカラー画像
+        """
+        if self._difference_color is not None:
+            # 飽和減算なので0未満にはならない
+            perspective_image = cv2.subtract(perspective_image, self._difference_color,
+                                             dst=self._buffer("difference", perspective_image.shape))
+        channel_image = self._buffer("channel", perspective_image.shape[:2])
+        channel_ranges = []
+        for channel in range(3):
+            cv2.extractChannel(perspective_image, channel, dst=channel_image)
+            mi, ma, _, _ = cv2.minMaxLoc(channel_image)
+            channel_ranges.append((mi, ma))
+        table = create_normalize_table(channel_ranges, self._is_inverted)
+        return cv2.LUT(perspective_image, table, dst=self._buffer("normalized", perspective_image.shape))
+
+    def to_gray_image(self, normalized_image):
+        """
+        設定されたグレースケール変換方法で、正規化されたカラー画像を白黒画像にする
+
+        :param normalized_image: 正規化されたカラー画像
+        :return: 白黒画像
+        """
+        gray_image = self._buffer("gray", normalized_image.shape[:2])
+        if self._gray_conversion_method == "projection":
+            return cv2.transform(normalized_image, self._projection_matrix, dst=gray_image)
+        if normalized_image.all() != 0:
+            gray_image, _ = cv2.decolor(normalized_image)
+            return gray_image
+        return cv2.cvtColor(normalized_image, cv2.COLOR_BGR2GRAY, dst=gray_image)
+
+    def to_normalized_gray_image(self, bgr_image, dst=None, perspective=None):
+        """
+        入力画像をOCR用に前処理する
+
+        :param bgr_image: 入力カラー画像
+        :param dst: 出力先の画像。Noneの場合は新しく確保する
+        :param perspective: 入力画像用のPerspectiveGeometry。Noneの場合は元の大きさの入力画像用
+        :return: 前処理された画像
+        """
+        return self.preprocess_perspective_image(self.warp(bgr_image, perspective=perspective), dst=dst)
+
+    def preprocess_perspective_image(self, perspective_image, dst=None):
+        """
+        射影変換された表示領域の画像をOCR用に前処理する。入力画像は変更しない
+
+        :param perspective_image: 射影変換された表示領域の画像
+        :param dst: 出力先の画像。Noneの場合は新しく確保する
+        :return: 前処理された画像
+        """
+        gray_image = self.to_gray_image(self.normalize_color_image(perspective_image))
+        height, width = gray_image.shape[:2]
+        kernel_size = int(height // 10) if height < width else int(width // 10)
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+        blurred_image = cv2.medianBlur(gray_image, kernel_size, dst=self._buffer("blurred", gray_image.shape))
+        return cv2.LUT(blurred_image, create_gray_normalize_table(blurred_image), dst=dst)
+
+
+def tile_images(images, spacing):
+    """
+    桁ごとの２値化画像を一定間隔で横一列に並べた画像を作成する
+    :param images: 桁数分の２値化画像
+    :param spacing: 桁画像の間隔と外周の余白(px)
+    :return: 横一列に並べた画像、桁ごとの横方向の範囲[(左端x,右端x)]
+    """
+    height = max(image.shape[0] for image in images) + 2 * spacing
+    width = sum(image.shape[1] for image in images) + (len(images) + 1) * spacing
+    tiled_image = np.zeros((height, width), dtype=np.uint8)
+    slots = []
+    left_x = spacing
+    for image in images:
+        image_height, image_width = image.shape[:2]
+        top_y = (height - image_height) // 2
+        tiled_image[top_y:top_y + image_height, left_x:left_x + image_width] = image
+        slots.append((left_x, left_x + image_width))
+        left_x += image_width + spacing
+    return tiled_image, slots
+
+
+def assign_characters_to_slots(characters, slots, spacing):
+    """
+    行単位のOCRで得られた文字を、文字枠の中心x座標から桁に割り当てる
+    :param characters: [(文字,左端x,右端x)]
+    :param slots: 桁ごとの横方向の範囲[(左端x,右端x)]
+    :param spacing: 桁画像の間隔(px)
+    :return: 桁ごとのOCR文字の配列。文字が割り当てられなかった桁は"NaN"
+    """
+    result = [""] * len(slots)
+    for character, left_x, right_x in characters:
+        center_x = (left_x + right_x) / 2
+        for i, (slot_left_x, slot_right_x) in enumerate(slots):
+            if slot_left_x - spacing / 2 <= center_x < slot_right_x + spacing / 2:
+                result[i] += character
+                break
+    return [ocr_string if ocr_string else "NaN" for ocr_string in result]
+
+
+def replace_psm(ocr_config, psm):
+    """
+    tesseractの設定文字列のページ分割モードを置き換える
+    :param ocr_config: tesseractのOCR用設定文字列
+    :param psm: ページ分割モード
+    :return: 置き換え後の設定文字列
+    """
+    if re.search(r"--psm\s+\d+", ocr_config):
+        return re.sub(r"--psm\s+\d+", f"--psm {psm}", ocr_config)
+    return f"{ocr_config} --psm {psm}"
+
+
 class TesseractOCREngine:
 
-    def __init__(self, ocr_config, tesseract_path):
+    def __init__(self, ocr_config, tesseract_path, line_psm=7):
         """
         :param ocr_config: tesseractのOCR用設定文字列
         :param tesseract_path: tesseractの実行ファイルのパス
+        :param line_psm: 行単位でOCRする時のページ分割モード
         :param display_region: ７セグ表示領域座標
         :param on_color: 点灯セグメントBGR値
         :param off_color: 消灯セグメントBGR値
@@ -178,6 +736,7 @@ class TesseractOCREngine:
         """
         self._ocr_config = ocr_config
         self._tesseract_path = tesseract_path
+        self._line_ocr_config = replace_psm(ocr_config, line_psm)
 
     def recognize_string(self, image):
         """
@@ -195,6 +754,28 @@ class TesseractOCREngine:
             print(f"Error during OCR extraction: {e}")
             return "Error"
 
+    def recognize_characters(self, image):
+        """
+        複数桁を並べた画像を１行としてOCRし、認識文字と文字枠を返す
+
+        :param image: 複数桁を横一列に並べた画像
+        :return: [(文字,左端x,右端x)]
+        """
+        try:
+            if os.name == 'nt':
+                pytesseract.pytesseract.tesseract_cmd = self._tesseract_path
+            boxes = pytesseract.image_to_boxes(Image.fromarray(image), config=self._line_ocr_config)
+        except Exception as e:
+            print(f"Error during OCR extraction: {e}")
+            return []
+        characters = []
+        for line in boxes.splitlines():
+            values = line.split(" ")
+            if len(values) < 5:
+                continue
+            characters.append((values[0], int(values[1]), int(values[3])))
+        return characters
+
     def _ocr(self, segment_image):
         """
         セグメント画像をOCRして認識文字を返す
@@ -211,6 +792,165 @@ class TesseractOCREngine:
             return "Error"
 
 
+def parse_tesseract_config(ocr_config):
+    """
+    tesseractのコマンドライン用設定文字列を、APIに渡せる設定値に分解する
+    :param ocr_config: "-l 7seg --psm 10 --oem 1 -c tessedit_char_whitelist=-0123456789 --dpi 300"形式の設定文字列
+    :return: {"lang": 言語, "psm": ページ分割モード, "oem": エンジンモード, "dpi": 解像度, "variables": {変数名: 値}}
+    """
+    tesseract_config = {"lang": "eng", "psm": 3, "oem": 3, "dpi": None, "variables": {}}
+    tokens = shlex.split(ocr_config)
+    for i, token in enumerate(tokens[:-1]):
+        value = tokens[i + 1]
+        if token == "-l":
+            tesseract_config["lang"] = value
+        elif token == "--psm":
+            tesseract_config["psm"] = int(value)
+        elif token == "--oem":
+            tesseract_config["oem"] = int(value)
+        elif token == "--dpi":
+            tesseract_config["dpi"] = int(value)
+        elif token == "-c":
+            name, variable = value.split("=", 1)
+            tesseract_config["variables"][name] = variable
+    return tesseract_config
+
+
+class TesseractAPIOCREngine:
+    """
+    tesseractのLSTMモデルをプロセス内に常駐させてOCRするエンジン
+    TesseractOCREngineと同じインターフェースで、画像ごとのプロセス起動と一時ファイル書き込みを行わない
+    """
+    # 設定文字列ごとに読み込み済みのAPIと排他ロックを保持する
+    _apis = {}
+    _apis_lock = threading.Lock()
+
+    def __init__(self, ocr_config, tessdata_path=None, line_psm=7):
+        """
+        :param ocr_config: tesseractのOCR用設定文字列
+        :param tessdata_path: 学習データ(traineddata)のフォルダパス。Noneの場合はtesseractの既定値
+        :param line_psm: 行単位でOCRする時のページ分割モード
+        """
+        if tesserocr is None:
+            raise ImportError("tesserocr is not installed")
+        self._ocr_config = ocr_config
+        self._tessdata_path = tessdata_path
+        self._line_psm = line_psm
+        self._tesseract_config = parse_tesseract_config(ocr_config)
+        self._api, self._lock = self._get_api()
+
+    def _get_api(self):
+        """
+        設定文字列に対応するAPIを返す。未作成の場合はモデルを読み込んで作成する
+        :return: (tesserocr.PyTessBaseAPI, threading.Lock)
+        """
+        key = (self._ocr_config, self._tessdata_path)
+        with self._apis_lock:
+            if key not in self._apis:
+                tesseract_config = self._tesseract_config
+                kwargs = {"lang": tesseract_config["lang"], "psm": tesseract_config["psm"],
+                          "oem": tesseract_config["oem"]}
+                if self._tessdata_path is not None:
+                    kwargs["path"] = self._tessdata_path
+                api = tesserocr.PyTessBaseAPI(**kwargs)
+                for name, value in tesseract_config["variables"].items():
+                    api.SetVariable(name, value)
+                self._apis[key] = (api, threading.Lock())
+            return self._apis[key]
+
+    def _set_image(self, image):
+        """
+        numpy配列の画像をPNGなどに変換せず、そのままAPIに渡す
+        :param image: 白黒画像またはカラー画像
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+        self._api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+        if self._tesseract_config["dpi"] is not None:
+            self._api.SetSourceResolution(self._tesseract_config["dpi"])
+
+    def recognize_string(self, image):
+        """
+        セグメント画像をOCRして認識文字を返す
+
+        :param image: 一桁セグメントの画像
+        :return: 一桁セグメントの画像のOCR文字
+        """
+        try:
+            with self._lock:
+                self._set_image(image)
+                ocr_string = self._api.GetUTF8Text()
+            return ocr_string.strip().replace(" ", "").replace("\n", "") if len(ocr_string) > 1 else "NaN"
+        except Exception as e:
+            print(f"Error during OCR extraction: {e}")
+            return "Error"
+
+    def recognize_characters(self, image):
+        """
+        複数桁を並べた画像を１行としてOCRし、認識文字と文字枠を返す
+
+        :param image: 複数桁を横一列に並べた画像
+        :return: [(文字,左端x,右端x)]
+        """
+        characters = []
+        try:
+            with self._lock:
+                self._api.SetPageSegMode(self._line_psm)
+                try:
+                    self._set_image(image)
+                    self._api.Recognize()
+                    iterator = self._api.GetIterator()
+                    for symbol in tesserocr.iterate_level(iterator, tesserocr.RIL.SYMBOL):
+                        character = symbol.GetUTF8Text(tesserocr.RIL.SYMBOL)
+                        box = symbol.BoundingBox(tesserocr.RIL.SYMBOL)
+                        if character and box is not None:
+                            characters.append((character.strip(), box[0], box[2]))
+                finally:
+                    self._api.SetPageSegMode(self._tesseract_config["psm"])
+        except Exception as e:
+            print(f"Error during OCR extraction: {e}")
+            return []
+        return characters
+
+
+def create_pattern_table(matching_pattern):
+    """
+    7bitの点灯状態を添字とする128要素の文字対応表を作成する
+    :param matching_pattern: {"点灯状態の0/1文字列": OCR文字}
+    :return: 対応表。表示パターンに無い点灯状態は"NaN"
+    """
+    pattern_table = np.full(128, "NaN", dtype=object)
+    for pattern, ocr_string in matching_pattern.items():
+        pattern_table[int(pattern, 2)] = ocr_string
+    return pattern_table
+
+
+def to_point_arrays(ocr_points):
+    """
+    桁数分の認識点座標を、インデックス参照用のy座標配列とx座標配列に変換する
+    :param ocr_points: 桁数分の７セグメントの認識点座標
+    :return: y座標配列(桁数, 7), x座標配列(桁数, 7)
+    """
+    point_ys = np.array([[point.y for point in points] for points in ocr_points], dtype=np.intp).reshape(-1, 7)
+    point_xs = np.array([[point.x for point in points] for points in ocr_points], dtype=np.intp).reshape(-1, 7)
+    return point_ys, point_xs
+
+
+def stack_images(images):
+    """
+    大きさの異なる画像を、最大の大きさに0埋めして１つの配列に重ねる
+    :param images: 画像の配列
+    :return: 重ねた画像(画像数, 最大高さ, 最大幅)
+    """
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+    stacked_images = np.zeros((len(images), height, width), dtype=np.uint8)
+    for i, image in enumerate(images):
+        stacked_images[i, :image.shape[0], :image.shape[1]] = image
+    return stacked_images
+
+
 class SegmentOCREngine:
     """
     ７セグメントの点灯状態を判別し、７セグ画像をOCRするエンジン
@@ -218,33 +958,24 @@ class SegmentOCREngine:
     matching_pattern = {"0000000": "", "1011111": "0", "0000011": "1", "1110110": "2", "1110011": "3", "0101011": "4",
                         "1111001": "5", "1111101": "6", "1000011": "7",  "1001011": "7","1111111": "8", "1101011": "9", "1111011": "9",
                         "0100000": "-"}
+    pattern_table = create_pattern_table(matching_pattern)
 
     def __init__(self, segment_color):
         self._segment_color = segment_color
 
-    def _calculate_7seg_state(self, binary_image, ocr_points):
+    def decode_segment_states(self, binary_images, point_ys, point_xs):
         """
-        7つのセグメントの認識点のON,OFFを配列で返す
-        :param binary_image: 2値化画像
-        :param ocr_points:１セグメントの７つのＯＣＲ認識点座標
-        :param display_region:1セグメントの画像領域(左上座標,右下座標)
-        :return:
+        全桁の認識点の画素を１回のインデックス参照でまとめて取り出し、7bitの点灯状態を対応表で文字に変換する
+        :param binary_images: 桁ごとの２値化画像を重ねた配列(..., 桁数, 高さ, 幅)。先頭の次元はフレームや２値化方法
+        :param point_ys: 桁ごとの７つの認識点のy座標(桁数, 7)
+        :param point_xs: 桁ごとの７つの認識点のx座標(桁数, 7)
+        :return: OCR文字の配列(..., 桁数)
         """
-        result = []
-        # print(ocr_points)
-        for point in ocr_points:
-            x = point.x
-            y = point.y
-            segment_value = binary_image[y, x]
-            result.append(self._calculate_segment_state(segment_value))
-        print(self._segment_color)
-        print(result)
-        return result
-
-    def _calculate_segment_state(self, segment_value):
-        if segment_value > 0:
-            return "1"
-        return "0"
+        digit_indices = np.arange(point_ys.shape[0])[:, np.newaxis]
+        segment_states = binary_images[..., digit_indices, point_ys, point_xs] > 0
+        # 1番目の認識点を最上位bitとして7bitを1byteに詰める(下位1bitは0埋め)
+        codes = np.packbits(segment_states, axis=-1)[..., 0] >> 1
+        return self.pattern_table[codes]
 
     def recognize_string(self, preprocessed_image, ocr_points):
         """
@@ -253,13 +984,8 @@ class SegmentOCREngine:
         :param segment_image: 一桁セグメントの画像
         :return: 一桁セグメントの画像のOCR文字
         """
-        # cv2.imwrite(f"{str(uuid.uuid4())}_test.jpg",preprocessed_image)
-        segment_state = self._calculate_7seg_state(preprocessed_image, ocr_points)
-        result = "".join(segment_state)
-        if result in self.matching_pattern:
-            return self.matching_pattern[result]
-        else:
-            return "NaN"
+        point_ys, point_xs = to_point_arrays([ocr_points])
+        return self.decode_segment_states(preprocessed_image[np.newaxis], point_ys, point_xs)[0]
 
 
 class DecimalPointOCREngine:
@@ -317,85 +1043,270 @@ class DecimalPointOCREngine:
             return "NaN"
 
 
+class BinarizationCache:
+    ADAPTIVE = "adaptive"
+    OTSU = "otsu"
+
+    def __init__(self, normalized_gray_image, segment_regions):
+        """
+        １フレームの前処理済み白黒画像から、２値化方法と領域ごとの２値化画像を一度だけ作って保持する。
+        セグメント認識・tesseract・小数点認識は同じ２値化画像を参照する
+
+        :param normalized_gray_image: 前処理された白黒画像
+        :param segment_regions: 桁領域(左上X,左上Y,右下X,右下Y)の配列
+        """
+        self.normalized_gray_image = normalized_gray_image
+        self._segment_regions = segment_regions
+        self._gray_images = {}
+        self._binary_images = {}
+
+    def gray_image(self, region_index=None, is_blurred=False):
+        """
+        領域の白黒画像を返す。平滑化しない場合は入力画像のビュー
+        :param region_index: 桁の番号。Noneの場合は表示領域全体
+        :param is_blurred: Trueの場合は9x9の平均化フィルタをかけた画像
+        :return: 白黒画像
+        """
+        key = (region_index, is_blurred)
+        gray_image = self._gray_images.get(key)
+        if gray_image is None:
+            if is_blurred:
+                gray_image = cv2.blur(self.gray_image(region_index), (9, 9))
+            elif region_index is None:
+                gray_image = self.normalized_gray_image
+            else:
+                p_left_x, p_left_y, p_right_x, p_right_y = self._segment_regions[region_index]
+                gray_image = roi_image(image=self.normalized_gray_image,
+                                       p_left_x=p_left_x,
+                                       p_left_y=p_left_y,
+                                       p_right_x=p_right_x,
+                                       p_right_y=p_right_y)
+            self._gray_images[key] = gray_image
+        return gray_image
+
+    def binary_image(self, method, region_index=None, is_blurred=False):
+        """
+        領域の２値化画像を返す。同じ２値化方法と領域の組は一度だけ２値化する
+        :param method: ２値化方法 BinarizationCache.ADAPTIVEまたはBinarizationCache.OTSU
+        :param region_index: 桁の番号。Noneの場合は表示領域全体
+        :param is_blurred: Trueの場合は9x9の平均化フィルタをかけた画像を２値化する
+        :return: ２値化画像
+        """
+        key = (method, region_index, is_blurred)
+        binary_image = self._binary_images.get(key)
+        if binary_image is None:
+            gray_image = self.gray_image(region_index, is_blurred)
+            if method == self.ADAPTIVE:
+                binary_image = binarize_gray_image_by_adaptive(gray_image)
+            else:
+                binary_image = binarize_gray_image_by_otsu(gray_image)
+            self._binary_images[key] = binary_image
+        return binary_image
+
+    def save_debug_images(self, directory):
+        """
+        前処理された白黒画像と、作成済みの桁ごとの画像をデバッグ用に保存する
+        :param directory: 保存先のディレクトリ
+        """
+        os.makedirs(directory, exist_ok=True)
+        cv2.imwrite(os.path.join(directory, "norm_gray_img.jpg"), self.normalized_gray_image)
+        for region_index, (p_left_x, _, _, _) in enumerate(self._segment_regions):
+            cv2.imwrite(os.path.join(directory, f"{p_left_x}_gray_img.jpg"), self.gray_image(region_index))
+            for method in (self.ADAPTIVE, self.OTSU):
+                binary_image = self._binary_images.get((method, region_index, True))
+                if binary_image is not None:
+                    cv2.imwrite(os.path.join(directory, f"{p_left_x}_{method}.jpg"), binary_image)
+
+
 class OCRHandler:
     segment_number = {"": 0, "0": 6, "1": 2, "2": 5, "3": 5, "4": 4, "5": 5, "6": 5, "7": 4, "8": 7, "9": 6, "-": 1}
 
-    def __init__(self, ocr_points, display_region, on_color, off_color, segment_regions, segment_ocr_engine,
-                 tesseract_ocr_engine, decimal_point_ocr_engine, is_off_segment_color):
+    def __init__(self, display_geometry, on_color, off_color, segment_ocr_engine,
+                 tesseract_ocr_engine, decimal_point_ocr_engine, is_off_segment_color, is_tesseract_line_mode=False,
+                 tesseract_line_spacing=20, is_cascade_mode=False, cascade_statistics=None,
+                 gray_conversion_method="decolor", debug_image_dir=None):
         """
-        :param ocr_points: 桁数分の７セグメントの認識点座標
-        :param display_region: ７セグ表示領域
+        :param display_geometry: ７セグ表示領域の射影変換と、桁数分の７セグメントの領域座標・認識点座標
         :param on_color: 点灯セグメントBGR値
         :param off_color: 消灯セグメントBGR値
-        :param segment_regions: 桁数分の７セグメントの領域座標
+        :param is_tesseract_line_mode: Trueの場合、全桁を横一列に並べた画像を１回のtesseract呼び出しでOCRする
+        :param tesseract_line_spacing: 行単位でOCRする時の桁画像の間隔(px)
+        :param is_cascade_mode: Trueの場合、セグメント認識で確定しなかった桁だけtesseractでOCRする
+        :param cascade_statistics: tesseractでOCRし直した回数の集計先
+        :param gray_conversion_method: グレースケール変換方法 "decolor"または"projection"
+        :param debug_image_dir: デバッグ用に前処理と２値化の画像を保存するディレクトリ。Noneの場合は保存しない
         """
-        self._ocr_points = ocr_points
-        self._display_region = display_region
+        self._display_geometry = display_geometry
+        self._segment_regions = display_geometry.segment_regions
         self._on_color = on_color
         self._off_color = off_color
-        self._segment_regions = segment_regions
         self._segment_ocr_engine = segment_ocr_engine
         self._tesseract_ocr_engine = tesseract_ocr_engine
         self._decimal_point_ocr_engine = decimal_point_ocr_engine
         self._is_off_segment_color = is_off_segment_color
+        self._is_tesseract_line_mode = is_tesseract_line_mode
+        self._tesseract_line_spacing = tesseract_line_spacing
+        self._is_cascade_mode = is_cascade_mode
+        self.cascade_statistics = cascade_statistics if cascade_statistics is not None else CascadeStatistics()
+        self._preprocessor = ImagePreprocessor(display_geometry=display_geometry,
+                                               on_color=on_color,
+                                               off_color=off_color,
+                                               is_off_segment_color=is_off_segment_color,
+                                               gray_conversion_method=gray_conversion_method)
+        self._debug_image_dir = debug_image_dir
+        # 直近のcalculate_ocr_valueで射影変換した表示領域の画像。画像ファイルのパスごとに保持し、saveで使い回す
+        self._region_images = {}
+
+    @property
+    def source_reduction(self):
+        """
+        表示領域の出力の大きさに対して、入力画像を縮小して読み込める縮小率
+        """
+        return self._display_geometry.perspective.reduction
 
-    def to_normalized_gray_image(self, bgr_image):
+    def to_normalized_gray_image(self, bgr_image, dst=None):
         """
         入力画像をOCR用に前処理する
 
         :param bgr_image: 入力カラー画像
+        :param dst: 出力先の画像。Noneの場合は新しく確保する
         :return:前処理された画像
         """
-        # 表示領域を抽出
-        perspective_image = get_perspective_image(self._display_region, bgr_image)
-        # cv2.imwrite("raw_img.jpg", perspective_image)
-        # 差分画素値の取得
-        diff_image = perspective_image
-        if self._is_off_segment_color:
-            diff_color = calculate_difference_color(self._on_color, self._off_color)
-            # 差分画像の取得
-            diff_image = to_difference_image(diff_color, perspective_image)
-            # cv2.imwrite("diff_img.jpg", diff_image)
-        # 正規化画像の取得
-        normalized_image = normalize_image(diff_image)
-
-        if np.sum(self._off_color) > np.sum(self._on_color):
-            normalized_image = cv2.bitwise_not(normalized_image)
-        # cv2.imwrite("norm_img.jpg", normalized_image)
-        # グレースケール画像の取得
-        gray_image = to_gray_image(normalized_image)
-
-        blurred_image = blur_image(gray_image)
-        # cv2.imwrite("gray_img.jpg", gray_image)
-        # 正規化したグレースケール画像の取得
-        normalized_gray_image = normalize_gray_image(blurred_image)
-        cv2.imwrite("norm_gray_img.jpg", normalized_gray_image)
-        return normalized_gray_image
+        return self._preprocessor.to_normalized_gray_image(bgr_image, dst=dst)
+
+    def load_region(self, image_path, frame_cache=None):
+        """
+        表示領域を含む範囲の画像を読み込む。frame_cacheがあれば読み込み済みのフレームから切り出す
+        :param image_path: 画像ファイルのパス
+        :param frame_cache: 同じ撮影分のフレームを共有するFrameCache。Noneの場合は画像ファイルから読み込む
+        :return: (読み込んだ範囲の画像, その画像用のPerspectiveGeometry)。読み込めない場合は(None, None)
+        """
+        if frame_cache is None:
+            return self._display_geometry.load_region(image_path)
+        frame = frame_cache.load(image_path)
+        if frame is None:
+            return None, None
+        return self._display_geometry.crop_region(frame, frame_cache.reduction)
+
+    def load_normalized_gray_image(self, image_path, dst=None):
+        """
+        画像ファイルから表示領域を含む範囲だけを読み込み、OCR用に前処理する
+
+        :param image_path: 画像ファイルのパス
+        :param dst: 出力先の画像。Noneの場合は新しく確保する
+        :return: 前処理された画像
+        """
+        region_image, perspective = self._display_geometry.load_region(image_path)
+        return self._preprocessor.to_normalized_gray_image(region_image, dst=dst, perspective=perspective)
+
+    def to_normalized_color_image(self, bgr_image):
+        """
+        入力画像から表示領域を切り出し、消灯セグメント色の差分と輝度の正規化をしたカラー画像を返す
+
+        :param bgr_image: 入力カラー画像
+        :return: 点灯セグメントが明るくなるように正規化されたカラー画像
+        """
+        return self._preprocessor.to_normalized_color_image(bgr_image).copy()
+
+    def to_gray_image(self, normalized_image):
+        """
+        設定されたグレースケール変換方法で、正規化されたカラー画像を白黒画像にする
+
+        :param normalized_image: 正規化されたカラー画像
+        :return: 白黒画像
+        """
+        return self._preprocessor.to_gray_image(normalized_image).copy()
+
+    def create_binarization_cache(self, normalized_gray_image):
+        """
+        前処理された白黒画像の２値化画像を保持するキャッシュを作る
+        :param normalized_gray_image: 前処理された白黒画像
+        :return: BinarizationCache
+        """
+        return BinarizationCache(normalized_gray_image, self._segment_regions)
 
     def image_to_string(self, bgr_image):
-        normalized_gray_image = self.to_normalized_gray_image(bgr_image)
+        binarization_cache = self.create_binarization_cache(self.to_normalized_gray_image(bgr_image))
 
-        tesseract_result = self.calculate_tesseract_result(normalized_gray_image)
-        segment_result = None
+        segment_ocr_strings = None
         if self._segment_ocr_engine is not None:
-            segment_result = self.calculate_segment_result(normalized_gray_image)
+            segment_ocr_strings = self._decode_segment_results([binarization_cache])[0]
+        return self._calculate_value(binarization_cache, segment_ocr_strings)
+
+    def _calculate_value(self, binarization_cache, segment_ocr_strings):
+        """
+        セグメント認識結果とtesseractのOCR結果を統合し、小数点位置を反映した数値を返す
+        :param binarization_cache: 前処理された白黒画像の２値化画像のキャッシュ
+        :param segment_ocr_strings: 適応的２値化と大津の２値化のセグメント認識結果の組。セグメント認識しない場合はNone
+        :return: 数値or"NaN"
+        """
+        segment_result = None
+        region_indices = None
+        if segment_ocr_strings is not None:
+            segment_result = self._select_segment_result(segment_ocr_strings)
+            if self._is_cascade_mode:
+                region_indices = self._find_uncertain_digits(segment_result)
+                self.cascade_statistics.add(digit_count=len(segment_result), fallback_count=len(region_indices))
+
+        tesseract_result = self.calculate_tesseract_result(binarization_cache, region_indices=region_indices)
         merged_segment_result = self._merge_results(tesseract_result,
                                                     segment_result) if segment_result else tesseract_result
 
         ocr_string = self._join_result(merged_segment_result)
         if ocr_string == "NaN":
+            # 読み取れなかったフレームの画像こそ確認したいので、ここでも保存する
+            self._save_debug_images(binarization_cache)
             return "NaN"
 
-        decimal_point = self.calculate_decimal_point(normalized_gray_image)
+        decimal_point = self.calculate_decimal_point(binarization_cache)
+        self._save_debug_images(binarization_cache)
 
         return float(ocr_string) / (10 ** decimal_point) if decimal_point != "NaN" else "NaN"
 
-    def calculate_ocr_value(self, images):
+    def _save_debug_images(self, binarization_cache):
+        if self._debug_image_dir is not None:
+            binarization_cache.save_debug_images(self._debug_image_dir)
+
+    def calculate_ocr_value(self, images, frame_cache=None):
+        """
+        複数フレームをOCRし、多数決で選んだ値とその画像ファイルのパスを返す
+        :param images: フレームの画像ファイルのパスの配列
+        :param frame_cache: 同じ撮影分のフレームを共有するFrameCache。Noneの場合は画像ファイルから読み込む
+        :return: (数値or"NaN", 画像ファイルのパス)。フレームを１枚も読み込めない場合は("NaN", None)
+        """
         majority_vote = OCRMajorityVote()
+        perspective = self._display_geometry.perspective
+        # 読み込めないフレームは飛ばす
+        loaded_regions = []
         for image_path in images:
-            image = load_image(image_path)
-            ocr_string = self.image_to_string(image)
+            bgr_image, source_perspective = self.load_region(image_path, frame_cache)
+            if bgr_image is None:
+                print(f"{image_path} could not be loaded. skipped")
+                continue
+            loaded_regions.append((image_path, bgr_image, source_perspective))
+        if not loaded_regions:
+            self._region_images = {}
+            return "NaN", None
+        images = [image_path for image_path, _, _ in loaded_regions]
+        # 全フレームの射影変換と前処理の結果はそれぞれ１つの配列にまとめて確保する
+        region_images = np.empty((len(images), perspective.height, perspective.width, 3), dtype=np.uint8)
+        normalized_gray_images = np.empty((len(images), perspective.height, perspective.width), dtype=np.uint8)
+        for (image_path, bgr_image, source_perspective), region_image, normalized_gray_image in zip(
+                loaded_regions, region_images, normalized_gray_images):
+            self._preprocessor.warp(bgr_image, perspective=source_perspective, dst=region_image)
+            self._preprocessor.preprocess_perspective_image(region_image, dst=normalized_gray_image)
+        self._region_images = dict(zip(images, region_images))
+        binarization_caches = [self.create_binarization_cache(normalized_gray_image)
+                               for normalized_gray_image in normalized_gray_images]
+        # セグメント認識は全フレーム分をまとめて判定する
+        segment_results = [None] * len(binarization_caches)
+        if self._segment_ocr_engine is not None and binarization_caches:
+            segment_results = self._decode_segment_results(binarization_caches)
+        for image_path, binarization_cache, segment_ocr_strings in zip(images, binarization_caches, segment_results):
+            ocr_string = self._calculate_value(binarization_cache, segment_ocr_strings)
             majority_vote.add(ocr_string, image_path)
+        if self._is_cascade_mode:
+            print(f"cascade_statistics:{self.cascade_statistics}")
         ocr_value, image_path = majority_vote.select()
         return ocr_value, image_path
 
@@ -430,66 +1341,124 @@ class OCRHandler:
         return int(ocr_string) if ocr_string.isdigit() else "NaN"
 
     def calculate_segment_result(self, normalized_gray_image):
-        result = []
-        # print(self._ocr_points)
-        for segment_region, ocr_points in zip(self._segment_regions, self._ocr_points):
-            p_left_x = int(segment_region["region_left_x"])
-            p_left_y = int(segment_region["region_left_y"])
-            p_right_x = int(segment_region["region_right_x"])
-            p_right_y = int(segment_region["region_right_y"])
-            clipped_image = roi_image(image=normalized_gray_image,
-                                      p_left_x=p_left_x,
-                                      p_left_y=p_left_y,
-                                      p_right_x=p_right_x,
-                                      p_right_y=p_right_y)
-            cv2.imwrite(f"clipped/{str(p_left_x)}_gray_img.jpg", clipped_image)
-            averaged_img = cv2.blur(clipped_image, (9, 9))
-            adaptive_binary_image = binarize_gray_image_by_adaptive(averaged_img)
-            otsu_binary_image = binarize_gray_image_by_otsu(averaged_img)
-            cv2.imwrite(f"clipped/{str(p_left_x)}_apaptive.jpg", adaptive_binary_image)
-            cv2.imwrite(f"clipped/{str(p_left_x)}_otsu.jpg", otsu_binary_image)
-            # print(ocr_points)
-            adaptive_ocr_string = self._segment_ocr_engine.recognize_string(adaptive_binary_image, ocr_points)
-            otsu_ocr_string = self._segment_ocr_engine.recognize_string(otsu_binary_image, ocr_points)
-
-            ocr_string = self.select_proper_ocr_string(adaptive_ocr_string, otsu_ocr_string)
-            result.append(ocr_string)
+        return self.calculate_segment_results([normalized_gray_image])[0]
+
+    def calculate_segment_results(self, normalized_gray_images):
+        """
+        複数フレームの全桁をまとめてセグメント認識し、フレームごとに結果を一桁ずつ配列に入れて返す
+        :param normalized_gray_images: 前処理された白黒画像の配列
+        :return: フレームごとのOCR結果配列の配列
+        """
+        binarization_caches = [self.create_binarization_cache(normalized_gray_image)
+                               for normalized_gray_image in normalized_gray_images]
+        return [self._select_segment_result(segment_ocr_strings)
+                for segment_ocr_strings in self._decode_segment_results(binarization_caches)]
+
+    def _decode_segment_results(self, binarization_caches):
+        """
+        複数フレームの全桁をまとめてセグメント認識し、フレームごとに２値化方法別の結果を返す
+        :param binarization_caches: フレームごとの２値化画像のキャッシュの配列
+        :return: フレームごとの(適応的２値化のOCR結果配列, 大津の２値化のOCR結果配列)の配列
+        """
+        if not self._segment_regions:
+            return [([], []) for _ in binarization_caches]
+        digit_count = len(self._segment_regions)
+        binary_images = [binarization_cache.binary_image(method, region_index, is_blurred=True)
+                         for binarization_cache in binarization_caches
+                         for method in (BinarizationCache.ADAPTIVE, BinarizationCache.OTSU)
+                         for region_index in range(digit_count)]
+
+        # (フレーム数, 2値化方法, 桁数, 高さ, 幅)に重ねて全認識点を一括で判定する
+        stacked_images = stack_images(binary_images)
+        stacked_images = stacked_images.reshape((len(binarization_caches), 2, digit_count) + stacked_images.shape[1:])
+        ocr_strings = self._segment_ocr_engine.decode_segment_states(stacked_images, self._display_geometry.point_ys,
+                                                                     self._display_geometry.point_xs)
+
+        return [(adaptive_ocr_strings.tolist(), otsu_ocr_strings.tolist())
+                for adaptive_ocr_strings, otsu_ocr_strings in ocr_strings]
+
+    def _select_segment_result(self, segment_ocr_strings):
+        """
+        ２値化方法別のセグメント認識結果を一桁ずつ比較し、適切な方の結果を配列に入れて返す
+        :param segment_ocr_strings: (適応的２値化のOCR結果配列, 大津の２値化のOCR結果配列)
+        :return: OCR結果配列
+        """
+        adaptive_ocr_strings, otsu_ocr_strings = segment_ocr_strings
+        result = [self.select_proper_ocr_string(adaptive_ocr_string, otsu_ocr_string)
+                  for adaptive_ocr_string, otsu_ocr_string in zip(adaptive_ocr_strings, otsu_ocr_strings)]
         print(f"segment_result:{result}")
         return result
 
-    def calculate_tesseract_result(self, normalized_gray_image):
+    @staticmethod
+    def _find_uncertain_digits(segment_result):
+        """
+        セグメント認識で読めなかった桁の番号を返す。
+        読めた桁は_merge_resultsでセグメント認識の結果が使われるので、tesseractでOCRしても結果は変わらない
+        :param segment_result: ２値化方法間で選んだセグメント認識結果配列
+        :return: tesseractでOCRする桁の番号の配列
+        """
+        return [i for i, ocr_string in enumerate(segment_result) if ocr_string == "NaN"]
+
+    def calculate_tesseract_result(self, binarization_cache, region_indices=None):
         """
         入力画像をＯＣＲして、結果を一桁ずつ配列に入れて返す
-        :param bgr_image: カラー画像
+        :param binarization_cache: 前処理された白黒画像の２値化画像のキャッシュ
+        :param region_indices: OCRする桁の番号の配列。Noneの場合は全桁。対象外の桁の結果は"NaN"
         :return: OCR結果配列
          """
-        result = []
-        for region in self._segment_regions:
-            p_left_x = int(region["region_left_x"])
-            p_left_y = int(region["region_left_y"])
-            p_right_x = int(region["region_right_x"])
-            p_right_y = int(region["region_right_y"])
-            clipped_image = roi_image(image=normalized_gray_image,
-                                      p_left_x=p_left_x,
-                                      p_left_y=p_left_y,
-                                      p_right_x=p_right_x,
-                                      p_right_y=p_right_y)
-
-            adaptive_binary_image = binarize_gray_image_by_adaptive(clipped_image)
-            otsu_binary_image = binarize_gray_image_by_otsu(clipped_image)
+        if region_indices is None:
+            region_indices = range(len(self._segment_regions))
+        if self._is_tesseract_line_mode:
+            return self.calculate_tesseract_line_result(binarization_cache, region_indices=region_indices)
+        result = ["NaN"] * len(self._segment_regions)
+        for i in region_indices:
+            adaptive_binary_image = binarization_cache.binary_image(BinarizationCache.ADAPTIVE, i)
+            otsu_binary_image = binarization_cache.binary_image(BinarizationCache.OTSU, i)
 
             adaptive_ocr_string = self._tesseract_ocr_engine.recognize_string(adaptive_binary_image)
             otsu_ocr_string = self._tesseract_ocr_engine.recognize_string(otsu_binary_image)
 
-            ocr_string = self.select_proper_ocr_string(adaptive_ocr_string, otsu_ocr_string)
-            result.append(ocr_string)
+            result[i] = self.select_proper_ocr_string(adaptive_ocr_string, otsu_ocr_string)
+        print(f"tesseract_result:{result}")
+        return result
+
+    def calculate_tesseract_line_result(self, binarization_cache, region_indices=None):
+        """
+        全桁の２値化画像を横一列に並べ、２値化方法ごとに１回のtesseract呼び出しでOCRして、結果を一桁ずつ配列に入れて返す
+        :param binarization_cache: 前処理された白黒画像の２値化画像のキャッシュ
+        :param region_indices: OCRする桁の番号の配列。Noneの場合は全桁。対象外の桁の結果は"NaN"
+        :return: OCR結果配列
+        """
+        if region_indices is None:
+            region_indices = range(len(self._segment_regions))
+        result = ["NaN"] * len(self._segment_regions)
+        if not region_indices:
+            return result
+        adaptive_binary_images = [binarization_cache.binary_image(BinarizationCache.ADAPTIVE, i) for i in region_indices]
+        otsu_binary_images = [binarization_cache.binary_image(BinarizationCache.OTSU, i) for i in region_indices]
+
+        adaptive_result = self._recognize_tiled_images(adaptive_binary_images)
+        otsu_result = self._recognize_tiled_images(otsu_binary_images)
+
+        for i, adaptive_ocr_string, otsu_ocr_string in zip(region_indices, adaptive_result, otsu_result):
+            result[i] = self.select_proper_ocr_string(adaptive_ocr_string, otsu_ocr_string)
         print(f"tesseract_result:{result}")
         return result
 
-    def calculate_decimal_point(self, normalized_gray_image):
+    def _recognize_tiled_images(self, binary_images):
+        """
+        桁ごとの２値化画像を横一列に並べてOCRし、認識文字を桁に割り当てる
+        :param binary_images: 桁数分の２値化画像
+        :return: 桁ごとのOCR文字の配列
+        """
+        tiled_image, slots = tile_images(binary_images, self._tesseract_line_spacing)
+        characters = self._tesseract_ocr_engine.recognize_characters(tiled_image)
+        return assign_characters_to_slots(characters, slots, self._tesseract_line_spacing)
+
+    def calculate_decimal_point(self, binarization_cache):
 
-        adaptive_binary_image = binarize_gray_image_by_adaptive(normalized_gray_image)
-        otsu_binary_image = binarize_gray_image_by_otsu(normalized_gray_image)
+        adaptive_binary_image = binarization_cache.binary_image(BinarizationCache.ADAPTIVE)
+        otsu_binary_image = binarization_cache.binary_image(BinarizationCache.OTSU)
 
         adaptive_result = self._decimal_point_ocr_engine.recognize_digit(adaptive_binary_image)
         otsu_result = self._decimal_point_ocr_engine.recognize_digit(otsu_binary_image)
@@ -536,12 +1505,46 @@ class OCRHandler:
         return s1
 
     def save(self, image_path, save_path):
-
-        bgr_image = load_image(image_path)
-        region_image = get_perspective_image(self._display_region, bgr_image)
+        """
+        表示領域の画像を保存する。calculate_ocr_valueで射影変換済みの画像はそれを使う
+        :param image_path: 画像ファイルのパス
+        :param save_path: 保存先のパス
+        """
+        region_image = self._region_images.get(image_path)
+        if region_image is None:
+            bgr_image, perspective = self._display_geometry.load_region(image_path)
+            region_image = perspective.warp(bgr_image)
         save_image(image=region_image, path=save_path)
 
 
+class CascadeStatistics:
+    """
+    カスケード方式でtesseractのOCRに切り替わった回数を設定ごとに集計する
+    """
+
+    def __init__(self):
+        self.frame_count = 0
+        self.fallback_frame_count = 0
+        self.digit_count = 0
+        self.fallback_digit_count = 0
+
+    def add(self, digit_count, fallback_count):
+        """
+        １フレーム分の集計を加える
+        :param digit_count: 桁数
+        :param fallback_count: tesseractでOCRした桁数
+        """
+        self.frame_count += 1
+        self.digit_count += digit_count
+        self.fallback_digit_count += fallback_count
+        if fallback_count > 0:
+            self.fallback_frame_count += 1
+
+    def __repr__(self):
+        return (f"frames:{self.fallback_frame_count}/{self.frame_count} "
+                f"digits:{self.fallback_digit_count}/{self.digit_count}")
+
+
 class OCRMajorityVote:
 
     def __init__(self):